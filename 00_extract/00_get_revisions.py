@@ -3,11 +3,17 @@
 
 import argparse
 import collections
+import hashlib
 import json
 import openreview
 import os
+import re
+import tempfile
+import time
 import tqdm
 
+import openreview_replay
+import scc_fetch_lib
 import scc_lib
 
 parser = argparse.ArgumentParser(description='')
@@ -27,6 +33,39 @@ parser.add_argument('-s',
                     default='./statuses/status_',
                     type=str,
                     help='prefix for tsv file with status of all forums')
+parser.add_argument('-j',
+                    '--jobs',
+                    default=1,
+                    type=int,
+                    help='number of forums to process concurrently')
+parser.add_argument('-r',
+                    '--rate',
+                    default=scc_fetch_lib.DEFAULT_RATE,
+                    type=float,
+                    help='maximum OpenReview API requests per second')
+parser.add_argument('-p',
+                    '--prefetch',
+                    action='store_true',
+                    help='bulk-fetch reviews and decisions for the whole '
+                    'conference instead of querying each forum')
+parser.add_argument('--since',
+                    nargs='?',
+                    const=-1,
+                    type=int,
+                    help='only reprocess forums revised or decided after this '
+                    'time (ms since epoch); without a value, since the last '
+                    'complete run')
+parser.add_argument('--record',
+                    type=str,
+                    help='record all API responses into this directory')
+parser.add_argument('--replay',
+                    type=str,
+                    help='serve API responses recorded with --record '
+                    'instead of using the network')
+parser.add_argument('--latency',
+                    default=0.0,
+                    type=float,
+                    help='artificial latency per replayed request, in seconds')
 parser.add_argument('-d', '--debug', action='store_true', help='')
 
 # == OpenReview-specific stuff ===============================================
@@ -45,21 +84,80 @@ class PDFStatus(object):
     NOT_FOUND = "not_found"
 
 
-GUEST_CLIENT = openreview.Client(baseurl="https://api.openreview.net")
+GUEST_CLIENT = None  # Created on first use, see get_guest_client
+
+
+def get_guest_client():
+    global GUEST_CLIENT
+    if GUEST_CLIENT is None:
+        # OPENREVIEW_BASEURL can point this at a local stand-in server for
+        # testing
+        GUEST_CLIENT = openreview.Client(baseurl=os.environ.get(
+            "OPENREVIEW_BASEURL", "https://api.openreview.net"))
+    return GUEST_CLIENT
+
+
+# Shared by all worker threads
+RATE_LIMITER = scc_fetch_lib.TokenBucket()
+
+
+def api_call(function, *args, **kwargs):
+    return scc_fetch_lib.call_with_backoff(RATE_LIMITER, function, *args,
+                                           **kwargs)
+
 
 PDF_ERROR_STATUS_LOOKUP = {
     "ForbiddenError": PDFStatus.FORBIDDEN,
     "NotFoundError": PDFStatus.NOT_FOUND,
 }
 
+PDF_HTTP_STATUS_LOOKUP = {
+    403: PDFStatus.FORBIDDEN,
+    404: PDFStatus.NOT_FOUND,
+}
+
 PDF_URL_PREFIX = "https://openreview.net/references/pdf?id="
 FORUM_URL_PREFIX = "https://openreview.net/forum?id="
 
+REFERENCE_CACHE_FILE = "reference_cache.jsonl"
+SYNC_STATE_FILE = "sync_state.json"
+SYNC_MARGIN = 60 * 60 * 1000  # ms
+
 INVITATIONS = {
     f"iclr_{year}": f"ICLR.cc/{year}/Conference/-/Blind_Submission"
     for year in range(2018, 2025)
 }
 
+# Reviews and decisions for a whole conference, for --prefetch. The first
+# invitation of each conference is the one decisions are posted to.
+PREFETCH_INVITATIONS = {
+    scc_lib.Conference.iclr_2018: [
+        "ICLR.cc/2018/Conference/-/Acceptance_Decision",
+        "ICLR.cc/2018/Conference/-/Paper.*/Official_Review",
+    ],
+    scc_lib.Conference.iclr_2019: [
+        "ICLR.cc/2019/Conference/-/Paper.*/Meta_Review",
+        "ICLR.cc/2019/Conference/-/Paper.*/Official_Review",
+    ],
+}
+PREFETCH_INVITATIONS.update({
+    f"iclr_{year}": [
+        f"ICLR.cc/{year}/Conference/Paper.*/-/Decision",
+        f"ICLR.cc/{year}/Conference/Paper.*/-/Official_Review",
+    ]
+    for year in range(2020, 2024)
+})
+DECISION_INVITATIONS = {
+    conference: invitations[0]
+    for conference, invitations in PREFETCH_INVITATIONS.items()
+}
+
+
+def is_decision(note, conference):
+    invitation = DECISION_INVITATIONS.get(conference)
+    return (invitation is not None
+            and re.fullmatch(invitation, note.invitation) is not None)
+
 
 def is_review(note, conference):
     if conference == scc_lib.Conference.iclr_2023:
@@ -74,8 +172,9 @@ def is_review(note, conference):
 
 # == Other helpers ===========================================================
 
-Review = collections.namedtuple("Review",
-                                "review_id sentences rating reviewer tcdate")
+# `sentences' is filled in later by 06_sentencize_reviews.py
+Review = collections.namedtuple(
+    "Review", "review_id text sentences rating reviewer tcdate")
 
 
 class ForumStatus(object):
@@ -93,36 +192,198 @@ def first_not_none(l):
     return None
 
 
+def prefetch_forum_notes(conference):
+    """Get review and decision notes for all forums in a few bulk queries.
+    """
+    forum_notes_index = collections.defaultdict(list)
+    for invitation in PREFETCH_INVITATIONS[conference]:
+        for note in api_call(get_guest_client().get_all_notes,
+                             invitation=invitation):
+            forum_notes_index[note.forum].append(note)
+    return forum_notes_index
+
+
+def read_high_water_mark(conference_dir):
+    try:
+        with open(f'{conference_dir}/{SYNC_STATE_FILE}', 'r') as f:
+            return json.load(f)['high_water_mark']
+    except FileNotFoundError:
+        return None
+
+
+def write_high_water_mark(conference_dir, high_water_mark):
+    scc_lib.write_file_atomically(
+        f'{conference_dir}/{SYNC_STATE_FILE}',
+        json.dumps({'high_water_mark': high_water_mark}, indent=2))
+
+
+def revised_since(forum, since):
+    """Whether a revision of the forum's paper was created after `since'.
+
+    Uses the same reference query as process_forum, limited to one result.
+    """
+    return bool(
+        api_call(get_guest_client().get_references,
+                 referent=forum.id,
+                 original=True,
+                 mintcdate=since + 1,
+                 limit=1))
+
+
+def get_decision_times(conference, since):
+    """Map each forum decided after `since' to its latest decision time."""
+    decision_times = {}
+    for note in api_call(get_guest_client().get_all_notes,
+                         invitation=DECISION_INVITATIONS[conference],
+                         mintcdate=since + 1):
+        decision_times[note.forum] = max(note.tcdate,
+                                         decision_times.get(note.forum, 0))
+    return decision_times
+
+
 # ============================================================================
 
 
-def get_binary(note):
-    try:  # try to get the PDF for this paper revision
-        pdf_binary = GUEST_CLIENT.get_pdf(note.id, is_reference=True)
-        pdf_status = PDFStatus.AVAILABLE
-    except openreview.OpenReviewException as e:
-        pdf_status = PDF_ERROR_STATUS_LOOKUP[e.args[0]["name"]]
-        pdf_binary = None
-    return pdf_status, pdf_binary
+def download_pdf(note, blob_dir):
+    """Stream the PDF for this paper revision into the blob store.
 
+    The body is hashed as it arrives and only moved into place once complete,
+    so memory use is bounded by the chunk size. Returns (status, digest).
+    """
+    os.makedirs(blob_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    temp_file = tempfile.NamedTemporaryFile(dir=blob_dir,
+                                            prefix='.download_',
+                                            delete=False)
+    try:
+        with temp_file:
+            for chunk in scc_fetch_lib.stream_pdf(get_guest_client(), note.id):
+                digest.update(chunk)
+                temp_file.write(chunk)
+    except openreview.OpenReviewException as e:
+        os.remove(temp_file.name)
+        name = e.args[0].get("name") if isinstance(e.args[0], dict) else None
+        if name not in PDF_ERROR_STATUS_LOOKUP:
+            raise  # e.g. throttling, which api_call retries
+        return PDF_ERROR_STATUS_LOOKUP[name], None
+    except BaseException:
+        os.remove(temp_file.name)
+        raise
+
+    blob_path = scc_lib.pdf_blob_path(blob_dir, digest.hexdigest())
+    if os.path.isfile(blob_path):
+        # Replacing the blob would unlink it from forums that share it
+        os.remove(temp_file.name)
+        return PDFStatus.AVAILABLE, digest.hexdigest()
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.chmod(temp_file.name, 0o644)  # Temporary files are private
+    os.replace(temp_file.name, blob_path)
+    return PDFStatus.AVAILABLE, digest.hexdigest()
+
+
+def probe_pdf(note):
+    """Check whether a PDF is available without downloading its body."""
+    status_code = scc_fetch_lib.probe_pdf_status(get_guest_client(), note.id)
+    if status_code == 200:
+        return PDFStatus.AVAILABLE
+    elif status_code in PDF_HTTP_STATUS_LOOKUP:
+        return PDF_HTTP_STATUS_LOOKUP[status_code]
+    else:  # Raised like the client would, so throttling is retried
+        raise openreview.OpenReviewException({
+            'name': 'Error',
+            'status': status_code
+        })
+
+
+def link_blob(blob_path, pdf_path):
+    if os.path.lexists(pdf_path):
+        os.remove(pdf_path)
+    try:
+        os.link(blob_path, pdf_path)
+    except OSError:  # e.g. blob store on another filesystem
+        os.symlink(os.path.relpath(blob_path, os.path.dirname(pdf_path)),
+                   pdf_path)
+
+
+def write_pdfs(forum_dir, blob_dir, initial_digest, final_digest):
+    old_manifest = scc_lib.read_pdf_manifest(forum_dir)
+    manifest = {scc_lib.INITIAL: initial_digest, scc_lib.FINAL: final_digest}
+    if old_manifest != manifest:
+        # The forum gained a new revision, or was fetched before manifests
+        # were written, so its PDFs may have changed: text and diffs must be
+        # recomputed. This happens before the manifest is written, so a crash
+        # in between leaves a manifest that still differs.
+        for filename in scc_lib.DERIVED_FILES:
+            if os.path.isfile(f'{forum_dir}/{filename}'):
+                os.remove(f'{forum_dir}/{filename}')
+
+    for version, digest in manifest.items():
+        assert digest is not None
+        link_blob(scc_lib.pdf_blob_path(blob_dir, digest),
+                  f'{forum_dir}/{version}.pdf')
+    scc_lib.write_file_atomically(f'{forum_dir}/{scc_lib.PDF_MANIFEST}',
+                                  json.dumps(manifest, indent=2))
+
+
+def get_reference_status(reference, reference_cache):
+    cached = reference_cache.get(reference)
+    if cached is not None:
+        status, _ = cached
+        return status
+    status = api_call(probe_pdf, reference)
+    reference_cache.put(reference, status, None)
+    return status
+
+
+def get_reference_blob(reference, blob_dir, reference_cache):
+    """Download a reference PDF unless the cache already knows its outcome.
+
+    References known to be forbidden or missing are not requested again, and
+    bodies that were already downloaded are found in the blob store. Returns
+    (status, digest).
+    """
+    cached = reference_cache.get(reference)
+    if cached is not None:
+        status, digest = cached
+        if status != PDFStatus.AVAILABLE:
+            return status, None
+        if digest is not None and os.path.isfile(
+                scc_lib.pdf_blob_path(blob_dir, digest)):
+            return status, digest
 
-def write_pdfs(forum_dir, initial_binary, final_binary):
-    for binary, version in [(initial_binary, scc_lib.INITIAL),
-                            (final_binary, scc_lib.FINAL)]:
-        assert binary is not None
-        with open(f'{forum_dir}/{version}.pdf', "wb") as f:
-            f.write(binary)
+    status, digest = api_call(download_pdf, reference, blob_dir)
+    reference_cache.put(reference, status, digest)
+    return status, digest
 
 
-def get_last_valid_reference(references):
+def get_last_available_reference(references, reference_cache):
     for r in reversed(references):
-        status, binary = get_binary(r)
-        if status == PDFStatus.AVAILABLE:
-            return (r, binary)
-    return None, None
+        if get_reference_status(r, reference_cache) == PDFStatus.AVAILABLE:
+            return r
+    return None
+
+
+def plan_references(references, first_review_time, reference_cache):
+    """Choose the final and initial references without downloading any PDF.
+
+    The final reference is the latest available one, and the initial reference
+    is the latest available one created before the first review.
+    """
+    final_reference = get_last_available_reference(references, reference_cache)
+    if final_reference is None or final_reference.tcdate <= first_review_time:
+        # No later revision can be the initial one, so this is either a
+        # paper without PDFs or one that was not revised after review.
+        return final_reference, final_reference
+
+    references_before_review = [
+        r for r in references if r.tcdate <= first_review_time
+    ]
+    initial_reference = get_last_available_reference(references_before_review,
+                                                     reference_cache)
+    return final_reference, initial_reference
 
 
-def get_review_sentences_and_rating(note, conference):
+def get_review_text_and_rating(note, conference):
     """Get raw review text. Review text field differs between years.
     """
     if conference == scc_lib.Conference.iclr_2023:
@@ -143,44 +404,49 @@ def get_review_sentences_and_rating(note, conference):
         review_text = note.content['review']
         rating = note.content['rating']
 
-    return [
-        sent.text
-        for sent in scc_lib.SENTENCIZE_PIPELINE(review_text).sentences
-    ], rating
+    return review_text, rating
 
 
 def write_metadata(forum_dir, forum, conference, initial_id, final_id,
                    decision, review_notes):
     reviews = []
     for review_note in review_notes:
-        review_sentences, rating = get_review_sentences_and_rating(
+        review_text, rating = get_review_text_and_rating(
             review_note, conference)
         reviews.append(
-            Review(review_note.id, review_sentences, rating,
+            Review(review_note.id, review_text, None, rating,
                    export_signature(review_note),
                    review_note.tcdate)._asdict())
-    with open(f'{forum_dir}/metadata.json', 'w') as f:
-        f.write(
-            json.dumps(
-                {
-                    'identifier': forum.id,
-                    'reviews': reviews,
-                    'decision': decision,
-                    'conference': conference,
-                    'urls': {
-                        'forum': f'{FORUM_URL_PREFIX}{forum.id}',
-                        'initial': f'{PDF_URL_PREFIX}{initial_id}',
-                        'final': f'{PDF_URL_PREFIX}{final_id}',
-                    }
-                },
-                indent=2))
-
-
-def process_forum(forum, conference, output_dir):
+    scc_lib.write_file_atomically(
+        f'{forum_dir}/metadata.json',
+        json.dumps(
+            {
+                'identifier': forum.id,
+                'reviews': reviews,
+                'decision': decision,
+                'conference': conference,
+                'urls': {
+                    'forum': f'{FORUM_URL_PREFIX}{forum.id}',
+                    'initial': f'{PDF_URL_PREFIX}{initial_id}',
+                    'final': f'{PDF_URL_PREFIX}{final_id}',
+                }
+            },
+            indent=2))
+
+
+def process_forum(forum,
+                  conference,
+                  output_dir,
+                  reference_cache,
+                  forum_notes_index=None):
 
     # === Get all notes, reviews, decisions, etc ==============================
 
-    forum_notes = GUEST_CLIENT.get_all_notes(forum=forum.id)
+    if forum_notes_index is not None:  # --prefetch
+        forum_notes = forum_notes_index.get(forum.id, [])
+    else:
+        forum_notes = api_call(get_guest_client().get_all_notes,
+                               forum=forum.id)
 
     # Retrieve all reviews from the forum
     review_notes = [
@@ -188,10 +454,16 @@ def process_forum(forum, conference, output_dir):
     ]
     # The conditions that make a note a review differ from year to year.
 
-    # Retrieve decision
+    # Retrieve decision. Notes of the decision invitation are looked at
+    # first, since some years' reviews also have a 'recommendation' field.
+    # This does not depend on the order of forum_notes, which differs between
+    # the per-forum query and --prefetch.
+    decision_notes = [
+        note for note in forum_notes if is_decision(note, conference)
+    ]
     decision = first_not_none([
         note.content.get('decision', note.content.get('recommendation', None))
-        for note in forum_notes
+        for note in decision_notes + forum_notes
     ])
     if decision is None:
         return ForumStatus.NO_DECISION, "None"
@@ -203,31 +475,40 @@ def process_forum(forum, conference, output_dir):
     # === Get `initial' and `final' pdfs ======================================
 
     # Retrieve all revisions of the manuscript in order of submission
-    references = sorted(GUEST_CLIENT.get_all_references(referent=forum.id,
-                                                        original=True),
+    references = sorted(api_call(get_guest_client().get_all_references,
+                                 referent=forum.id,
+                                 original=True),
                         key=lambda x: x.tcdate)
 
     # Valid references are those associated with a valid PDF.
-
-    # --- final submission ----------------------------------------------------
-    # The latest valid revision
-
-    # The 'final' version is the latest valid version
-    final_reference, final_binary = get_last_valid_reference(references)
-
-    # --- initial submission --------------------------------------------------
-    # The latest valid pre-review revision
+    blob_dir = scc_lib.pdf_blob_dir(output_dir)
 
     # Creation time of first review:
     # Changes made before this time cannot have been influenced by reviewers.
     first_review_time = min(rev.tcdate for rev in review_notes)
 
-    references_before_review = [
-        r for r in references if r.tcdate <= first_review_time
-    ]
-    # The initial revision is the latest valid revision of the list above
-    initial_reference, initial_binary = get_last_valid_reference(
-        references_before_review)
+    # The 'final' version is the latest valid revision, and the 'initial'
+    # version is the latest valid pre-review revision. Both are chosen using
+    # cheap availability checks, so PDFs are only downloaded for forums with
+    # distinct initial and final versions.
+    while True:
+        final_reference, initial_reference = plan_references(
+            references, first_review_time, reference_cache)
+        if final_reference is None or initial_reference is None:
+            break
+        if final_reference.id == initial_reference.id:
+            break
+
+        final_status, final_digest = get_reference_blob(
+            final_reference, blob_dir, reference_cache)
+        if final_status != PDFStatus.AVAILABLE:
+            continue
+        initial_status, initial_digest = get_reference_blob(
+            initial_reference, blob_dir, reference_cache)
+        if initial_status == PDFStatus.AVAILABLE:
+            break
+        # Otherwise a download failed after a successful check. The failure is
+        # now in the cache, so planning again falls back to the next candidate.
 
     # === Finalize ============================================================
 
@@ -241,7 +522,7 @@ def process_forum(forum, conference, output_dir):
             os.makedirs(forum_dir, exist_ok=True)
 
             # Write pdfs and metadata
-            write_pdfs(forum_dir, initial_binary, final_binary)
+            write_pdfs(forum_dir, blob_dir, initial_digest, final_digest)
             write_metadata(forum_dir, forum, conference, initial_reference.id,
                            final_reference.id, decision, review_notes)
 
@@ -255,33 +536,106 @@ def process_forum(forum, conference, output_dir):
 
 
 def main():
+    global GUEST_CLIENT
 
     args = parser.parse_args()
+    RATE_LIMITER.set_rate(args.rate)
+    if args.replay:
+        GUEST_CLIENT = openreview_replay.ReplayClient(args.replay,
+                                                      args.latency)
+    elif args.record:
+        GUEST_CLIENT = openreview_replay.RecordingClient(
+            get_guest_client(), args.record)
 
     # A directory will be made for each paper submission under the output directory.
     final_dir = f'{args.output_dir}/{args.conference}/'
     os.makedirs(final_dir, exist_ok=True)
 
-    # Gets top level notes for each `forum' (each paper submission is assigned
-    # a forum)
-    forum_notes = GUEST_CLIENT.get_all_notes(
-        invitation=INVITATIONS[args.conference])
+    # Statuses are recorded in a journal, which is compacted into the status
+    # file at the end of the run. Forums in the journal are already finished.
+    status_file = f'{args.status_file_prefix}{args.conference}.tsv'
+    journal = scc_fetch_lib.StatusJournal(
+        f'{args.status_file_prefix}{args.conference}.journal')
+    if not len(journal) and os.path.isfile(status_file):
+        journal.import_tsv(status_file)  # Status file from an older run
 
     # Hack for --debug
     success_count = 0
 
-    status_file = f'{args.status_file_prefix}{args.conference}.tsv'
-    if not os.path.isfile(status_file):
-        with open(status_file, 'w') as f:
-            f.write('#Conference\tForum\tStatus\tDecision\n')
+    # With --since, finished forums are reprocessed if they were decided or
+    # revised after the high-water mark. Decisions are found in one query for
+    # the conference, and revisions by a reference query for each forum.
+    since = args.since
+    if since == -1:
+        since = read_high_water_mark(final_dir)
+    decision_times = {}
+    if since is not None:
+        decision_times = get_decision_times(args.conference, since)
+    # Notes created after this are seen by the next --since run. The margin
+    # allows for the clocks here and on the API server differing.
+    high_water_mark = int(time.time() * 1000) - SYNC_MARGIN
 
-    with open(status_file, 'a') as f:
-        for forum in tqdm.tqdm(forum_notes):
-            if os.path.isfile(f'{final_dir}/{forum.id}/metadata.json'):
+    # Gets top level notes for each `forum' (each paper submission is assigned
+    # a forum). Notes are streamed page by page, so processing starts right
+    # away and only a bounded window of notes is in memory.
+    invitation = INVITATIONS[args.conference]
+    progress = tqdm.tqdm(total=scc_fetch_lib.count_notes(
+        RATE_LIMITER, get_guest_client(), invitation=invitation))
+    forum_notes = scc_fetch_lib.iter_notes(RATE_LIMITER,
+                                           get_guest_client(),
+                                           invitation=invitation)
+
+    def pending_forums():
+        for forum in forum_notes:
+            if forum.id in journal and since is None:
+                progress.update()
+                continue
+            yield forum
+
+    # Outcome of every reference PDF request, kept across runs
+    reference_cache = scc_fetch_lib.ReferenceCache(
+        f'{final_dir}/{REFERENCE_CACHE_FILE}')
+
+    forum_notes_index = None
+    if args.prefetch:
+        forum_notes_index = prefetch_forum_notes(args.conference)
+
+    def refresh_forum(forum):
+        """Process a forum, or return None if it is finished and unchanged.
+
+        Runs on a worker thread, so the reference query for --since is
+        spread over the workers too.
+        """
+        if (forum.id in journal and forum.id not in decision_times
+                and not revised_since(forum, since)):
+            return None
+        return process_forum(forum,
+                             conference=args.conference,
+                             output_dir=final_dir,
+                             reference_cache=reference_cache,
+                             forum_notes_index=forum_notes_index)
+
+    def record_status(forum, result):
+        if result is not None:
+            status, decision = result
+            journal.append(args.conference, forum.id, status, decision)
+
+    # Process a forum. As a side effect, write pdfs to directory. Forums still
+    # in flight when the loop stops are journaled by record_status too, since
+    # their pdfs are written anyway.
+    results = scc_fetch_lib.map_unordered(refresh_forum,
+                                          pending_forums(),
+                                          args.jobs,
+                                          on_abandoned=record_status)
+
+    # Status rows are only written from this thread, once per forum
+    try:
+        for forum, result in results:
+            progress.update()
+            if result is None:  # Unchanged since the last run
                 continue
-            # Process a forum. As a side effect, write pdfs to directory.
-            status, decision = process_forum(forum, args.conference, final_dir)
-            f.write(f'{args.conference}\t{forum.id}\t{status}\t{decision}\n')
+            record_status(forum, result)
+            status, decision = result
 
             # === --debug stuff ===
             if status == ForumStatus.COMPLETE:
@@ -289,8 +643,17 @@ def main():
             if args.debug and success_count == 10:
                 break
             # === end --debug stuff ===
-            if success_count % 10 == 0:
-                f.flush()
+        else:
+            # Every forum was seen, so later runs can sync from here
+            write_high_water_mark(final_dir, high_water_mark)
+    finally:
+        results.close()  # Waits for forums in flight
+        journal.sync()
+
+    progress.close()
+    reference_cache.close()
+    journal.compact(status_file)
+    journal.close()
 
 
 if __name__ == "__main__":
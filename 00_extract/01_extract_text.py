@@ -1,12 +1,25 @@
-"""Extract text from OpenReview PDFs.
+"""Extract text from OpenReview PDFs and clean out ICLR boilerplate.
+
+The cleaned text (initial.txt, final.txt) is produced in one streaming pass
+over the pdftotext output. The intermediate *_raw.txt files, which
+02_clean_iclr.py also cleans, are only written with --write_raw.
+
+Extraction is page-aware: the offset at which each page starts in the cleaned
+text is written to initial_pages.json / final_pages.json.
 """
 
 import argparse
+import collections
+import concurrent.futures.process
+import functools
 import glob
+import json
 import os
-import tqdm
+import shutil
 import subprocess
+import tqdm
 
+import pdfdiff
 import scc_lib
 
 parser = argparse.ArgumentParser(description="")
@@ -23,54 +36,262 @@ parser.add_argument("-c",
                     choices=scc_lib.Conference.ALL,
                     help="conference_year, e.g. iclr_2022",
                     required=True)
+parser.add_argument("-j",
+                    "--jobs",
+                    default=1,
+                    type=int,
+                    help="number of PDFs to extract in parallel")
+parser.add_argument("-t",
+                    "--timeout",
+                    default=300,
+                    type=int,
+                    help="seconds allowed for extracting a single PDF")
+parser.add_argument("-w",
+                    "--write_raw",
+                    action="store_true",
+                    help="also write uncleaned *_raw.txt files, for debugging")
+parser.add_argument("-p",
+                    "--page_jobs",
+                    default=1,
+                    type=int,
+                    help="number of page ranges of a large PDF to extract "
+                    "in parallel")
+
+ERROR_REPORT = "extract_errors.jsonl"
+
+
+def raw_lines(page_lines):
+    """Clean up whitespace in (page index, normalized line) pairs.
+
+    Hyphenated line breaks are removed, single line breaks become spaces, and
+    runs of line breaks are kept as paragraph breaks. Yields (page index, line)
+    pairs, where the page is the one on which the line starts.
+    """
+    line = []
+    line_page = None
+    newlines = 0  # line breaks since the last text
+    for page, normalized_line in page_lines:
+        text = normalized_line[:-1]
+        hyphenated = text.endswith("-")
+        if hyphenated:
+            text = text[:-1]  # remove hyphenations
+        if text:
+            if newlines == 1:
+                line.append(" ")  # remove line breaks
+            elif newlines:
+                yield line_page, "".join(line)  # restore real newlines
+                line = [" "] if newlines % 2 else []
+                line_page = None
+            newlines = 0
+            if line_page is None:
+                line_page = page
+            # \r is a line break too when the text is read back
+            first, *rest = text.split("\r")
+            line.append(first)
+            for part in rest:
+                yield line_page, "".join(line)
+                line = [part]
+                line_page = page
+        if not hyphenated:
+            newlines += 1
+    yield line_page or 0, "".join(line)
+
+
+def clean_pages(page_lines, page_count):
+    """Clean raw (page index, line) pairs with scc_lib.clean_lines.
+
+    Returns the cleaned text and the offset at which each page starts in it.
+    A page starts at its first cleaned line; pages without any (e.g. those
+    after the references) start where the next page does.
+    """
+    page = 0
+
+    def lines():
+        nonlocal page
+        # clean_lines only reads a line once it is done with the previous one
+        for page, line in page_lines:
+            yield line
+
+    cleaned_lines = []
+    offsets = []
+    length = 0
+    for cleaned_line in scc_lib.clean_lines(lines()):
+        while len(offsets) <= page:
+            offsets.append(length)
+        cleaned_lines.append(cleaned_line)
+        length += len(cleaned_line) + 1
+    text = "\n".join(cleaned_lines)
+    offsets += [len(text)] * (page_count - len(offsets))
+    return text, offsets
+
+
+def text_path(pdf_path):
+    return pdf_path.replace('.pdf', '.txt')
+
 
-PLACEHOLDER = "$$$$$$$$$$$$$"
+def raw_text_path(pdf_path):
+    return pdf_path.replace('.pdf', '_raw.txt')
 
-ERROR_PREFIX = "Error: Could not find 'pdftotext'"
 
+def pages_path(pdf_path):
+    return pdf_path.replace('.pdf', '_pages.json')
 
-def extract_text(pdf_path):
-    # pdfdiff with only one command line argument simply extracts pdf text.
-    output = subprocess.run(["python", "pdfdiff.py", pdf_path],
-                            capture_output=True).stdout
-    # TODO: check for errors
 
-    output = output.decode()
-    if output.startswith(ERROR_PREFIX):
-        return None
+def plan_extraction(pdf_paths):
+    """Split PDFs into ones to extract and byte-identical duplicates.
 
-    return (output.replace(  # clean up whitespace
-        "-\n",
-        ""  # remove hyphenations
-    ).replace(
-        "\n\n",
-        PLACEHOLDER  # placeholder for real newlines
-    ).replace(
-        "\n",
-        " "  # remove line breaks
-    ).replace(
-        PLACEHOLDER,
-        "\n\n"  # restore real newlines
-    ))
+    Duplicates are (pdf_path, source_pdf_path) pairs, where source_pdf_path is
+    the PDF with the same blob in the same forum whose text will be copied.
+    """
+    to_extract = []
+    duplicates = []
+    sources = {}  # (forum_dir, digest) -> pdf_path
+    for pdf_path in sorted(pdf_paths):
+        forum_dir, pdf_name = os.path.split(pdf_path)
+        manifest = scc_lib.read_pdf_manifest(forum_dir)
+        digest = None
+        if manifest is not None:
+            digest = manifest.get(pdf_name[:-len('.pdf')])
+        if digest is not None:
+            # Text of the same blob extracted in an earlier run
+            for version, other_digest in manifest.items():
+                other_pdf_path = f'{forum_dir}/{version}.pdf'
+                if (other_digest == digest and other_pdf_path != pdf_path
+                        and os.path.isfile(text_path(other_pdf_path))):
+                    sources.setdefault((forum_dir, digest), other_pdf_path)
+            if (forum_dir, digest) in sources:
+                duplicates.append((pdf_path, sources[(forum_dir, digest)]))
+                continue
+            sources[(forum_dir, digest)] = pdf_path
+        to_extract.append(pdf_path)
+    return to_extract, duplicates
+
+
+def extract_pdf(pdf_path, timeout, write_raw=False, page_jobs=1):
+    """Extract one PDF, returning (pdf_path, error message or None).
+
+    Runs in a worker process. Errors are reported rather than raised so that
+    one bad PDF does not stop the others. The timeout is for all external
+    programs run on the PDF together.
+    """
+    try:
+        page_count, page_lines = pdfdiff.normalize_file_pages(
+            pdf_path, timeout, page_jobs)
+        page_lines = raw_lines(page_lines)
+        if write_raw:
+            page_lines = list(page_lines)
+            scc_lib.write_file_atomically(
+                raw_text_path(pdf_path),
+                "\n".join(line for _, line in page_lines))
+        cleaned, offsets = clean_pages(page_lines, page_count)
+    except pdfdiff.ToolNotFoundError:
+        raise
+    except subprocess.TimeoutExpired:
+        return pdf_path, f"extraction timed out after {timeout}s"
+    except Exception as e:
+        return pdf_path, f"{type(e).__name__}: {e}"
+    # Written atomically so a half-written text file never looks complete
+    scc_lib.write_file_atomically(pages_path(pdf_path), json.dumps(offsets))
+    scc_lib.write_file_atomically(text_path(pdf_path), cleaned)
+    return pdf_path, None
+
+
+def extract_all(extract, pdf_paths, jobs):
+    """Yield (pdf_path, error message or None) for each PDF, in any order.
+
+    With jobs > 1, PDFs are extracted in worker processes. If a worker dies
+    (e.g. killed for running out of memory), the pool is broken and fails all
+    PDFs in flight. Those are extracted again one at a time, each in a fresh
+    process, so only the PDF that kills its worker is reported, and the rest
+    continue in a new pool. Nothing more is submitted to a broken pool.
+    """
+    if jobs <= 1:
+        yield from map(extract, pdf_paths)
+        return
+
+    queue = collections.deque(pdf_paths)
+    while queue:
+        crashed = []
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            pending = {}
+            broken = False
+            while (queue or pending) and not broken:
+                while queue and len(pending) < 2 * jobs:
+                    try:
+                        future = executor.submit(extract, queue[0])
+                    except concurrent.futures.process.BrokenProcessPool:
+                        # Not taken off the queue, so the next pool gets it
+                        broken = True
+                        break
+                    pending[future] = queue.popleft()
+                if broken:
+                    break
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pdf_path = pending.pop(future)
+                    try:
+                        yield future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        crashed.append(pdf_path)
+                        broken = True
+            # Once the pool is broken, the PDFs still in flight have either
+            # finished or failed with it
+            for future, pdf_path in pending.items():
+                try:
+                    yield future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    crashed.append(pdf_path)
+
+        for pdf_path in crashed:
+            with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                try:
+                    yield executor.submit(extract, pdf_path).result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    yield pdf_path, "worker process died"
+
+
+def copy_file_atomically(source_path, path):
+    temp_path = f'{path}.tmp'
+    shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, path)
 
 
 def main():
     args = parser.parse_args()
-    for pdf_path in tqdm.tqdm(
-            list(glob.glob(f"{args.data_dir}/{args.conference}/*/*.pdf"))):
-        print(pdf_path)
-        output_path = pdf_path.replace('.pdf', '_raw.txt')
-        if os.path.isfile(output_path):
-            # PDF text has already been extracted
-            continue
+    pdf_paths = [
+        pdf_path
+        for pdf_path in glob.glob(f"{args.data_dir}/{args.conference}/*/*.pdf")
+        # Skip PDFs whose text has already been extracted
+        if not os.path.isfile(text_path(pdf_path))
+    ]
+    to_extract, duplicates = plan_extraction(pdf_paths)
+
+    extract = functools.partial(extract_pdf,
+                                timeout=args.timeout,
+                                write_raw=args.write_raw,
+                                page_jobs=args.page_jobs)
+    errors = {}
+    for pdf_path, error in tqdm.tqdm(extract_all(extract, to_extract,
+                                                 args.jobs),
+                                     total=len(to_extract)):
+        if error is not None:
+            print(f"{pdf_path}: {error}")
+            errors[pdf_path] = error
+
+    for pdf_path, source_pdf_path in duplicates:
+        # Same PDF blob as the other version, no need to extract again
+        if os.path.isfile(text_path(source_pdf_path)):
+            for path_of in [raw_text_path, pages_path, text_path]:
+                if os.path.isfile(path_of(source_pdf_path)):
+                    copy_file_atomically(path_of(source_pdf_path),
+                                         path_of(pdf_path))
         else:
-            with open(output_path, 'w') as f:
-                text = extract_text(pdf_path)
-                if text is not None:
-                    f.write(text)
-                else:
-                    print("pdftotext error")
-                    break
+            errors[pdf_path] = f"duplicate of failed {source_pdf_path}"
+
+    with open(f"{args.data_dir}/{args.conference}/{ERROR_REPORT}", 'w') as f:
+        for pdf_path, error in sorted(errors.items()):
+            f.write(json.dumps({"pdf": pdf_path, "error": error}) + "\n")
 
 
 if __name__ == "__main__":
@@ -5,9 +5,6 @@ Also, leave out references (for now)
 
 import argparse
 import glob
-import json
-import sys
-import re
 import tqdm
 
 import scc_lib
@@ -27,57 +24,10 @@ parser.add_argument("-c",
                     help="conference_year, e.g. iclr_2022",
                     required=True)
 
-UNDER_REVIEW_RE = re.compile(
-    "Under review as a conference paper at ICLR 20[0-9]{2}")
-#Under review as a conference paper at ICLR 2022
-PUBLISHED_RE = re.compile("Published as a conference paper at ICLR 20[0-9]{2}")
-REFERENCE_START = re.compile("^R\s?EFERENCES")
-
-ABSTRACT = "ABSTRACT"
-REFERENCES = "REFERENCES"
-
-#TODO: find out what ABSTRACT_HEADER and SECTION_HEADER as supposed to do
-
 
 def clean_file(filename):
-
     with open(filename, 'r') as f:
-        lines = [line.strip() for line in f.readlines()]
-
-    boilerplate_re = None  # Sometimes this doesn't match anywhere?
-
-    # Figure out what the boilerplate line is. For rejected papers, the final
-    # pdf may still be 'Under review'.
-    for line in lines:
-        if UNDER_REVIEW_RE.match(line):
-            boilerplate_re = UNDER_REVIEW_RE
-            break
-        elif PUBLISHED_RE.match(line):
-            boilerplate_re = PUBLISHED_RE
-            break
-
-    final_lines = []
-
-    for line in lines:
-        if not line:
-            continue
-        if line.startswith("R EFERENCES") or line.startswith(REFERENCES):
-            # Typo fixed in 2022
-            # References starting. We are done.
-            break
-        matched = False
-        if boilerplate_re is not None and boilerplate_re.match(line):
-            final_lines += re.split(boilerplate_re, line)
-        elif ABSTRACT in line and not line.startswith(ABSTRACT):
-            try:
-                before, after = re.split(ABSTRACT, line)
-                final_lines += [before, ABSTRACT + after]
-            except ValueError:
-                final_lines.append(line)
-        else:
-            final_lines.append(line)
-
-    return "\n".join(final_lines)
+        return "\n".join(scc_lib.clean_lines(f))
 
 
 def main():
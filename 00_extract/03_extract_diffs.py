@@ -1,10 +1,13 @@
 import argparse
+import functools
 import glob
 import json
 import os
 import tqdm
 
+import scc_diff_lib
 import scc_lib
+import scc_tokenize_lib
 from scc_diff_lib import DocumentDiff
 
 parser = argparse.ArgumentParser(description="")
@@ -15,6 +18,33 @@ parser.add_argument("-c",
                     choices=scc_lib.Conference.ALL,
                     help="conference_year, e.g. iclr_2022",
                     required=True)
+parser.add_argument("-b",
+                    "--batch_size",
+                    default=32,
+                    type=int,
+                    help="number of forums to tokenize in one stanza call")
+parser.add_argument("-t",
+                    "--tokenizer",
+                    default=scc_tokenize_lib.STANZA,
+                    choices=scc_tokenize_lib.TOKENIZERS,
+                    help="regex is faster, stanza segments sentences better")
+parser.add_argument("-p",
+                    "--by_paragraph",
+                    action="store_true",
+                    help="tokenize and memoize each paragraph separately; "
+                    "see scc_tokenize_lib.ParagraphTokenizer")
+parser.add_argument("-j",
+                    "--jobs",
+                    default=1,
+                    type=int,
+                    help="number of processes to tokenize on; long texts are "
+                    "split into chunks")
+parser.add_argument("-m",
+                    "--matcher",
+                    default=scc_diff_lib.DIFFLIB,
+                    choices=scc_diff_lib.MATCHERS,
+                    help="how to find matching blocks; patience and histogram "
+                    "anchor on rare tokens, see benchmark_matchers.py")
 
 
 def generate_filenames(initial_text_file):
@@ -29,27 +59,89 @@ def read_sentencized(filename):
         return [line.split() for line in f.readlines()]
 
 
-def get_tokens(filename):
-    #print("tokenizing")
+def read_text(filename):
     with open(filename, 'r') as f:
-        text = f.read()
-        return list([t.to_dict()[0]['text'] for t in s.tokens]
-                    for s in scc_lib.SENTENCIZE_PIPELINE(text).sentences)
+        return f.read()
 
 
-def main():
-    args = parser.parse_args()
-    for initial_filename in tqdm.tqdm(
-            list(glob.glob(
-                f"{args.data_dir}/{args.conference}/*/initial.txt"))):
+@functools.lru_cache(maxsize=None)
+def get_token_cache(conference_dir,
+                    tokenizer=scc_tokenize_lib.STANZA,
+                    by_paragraph=False,
+                    jobs=1):
+    # Kept for the whole run, so the paragraph memo and the tokenizing
+    # processes are shared by all forums
+    return scc_tokenize_lib.TokenCache(
+        scc_tokenize_lib.token_cache_dir(conference_dir), tokenizer,
+        by_paragraph, jobs)
+
+
+def get_tokens(filename,
+               tokenizer=scc_tokenize_lib.STANZA,
+               by_paragraph=False,
+               jobs=1):
+    conference_dir = os.path.dirname(os.path.dirname(filename))
+    return scc_tokenize_lib.tokenize_cached([read_text(filename)],
+                                            get_token_cache(
+                                                conference_dir, tokenizer,
+                                                by_paragraph, jobs))[0]
+
+
+def extract_diffs_batch(initial_filenames,
+                        tokenizer=scc_tokenize_lib.STANZA,
+                        by_paragraph=False,
+                        jobs=1,
+                        matcher=scc_diff_lib.DIFFLIB):
+    """Diff several forums, tokenizing all of their texts in one batch.
 
-        final_filename, diff_file, forum = generate_filenames(initial_filename)
+    Texts are read through the token cache, so recomputing a diff does not
+    tokenize again.
+    """
+    # Both versions may have been extracted from the same PDF blob
+    same_blob = [
+        scc_lib.same_pdf_blob(os.path.dirname(initial_filename))
+        for initial_filename in initial_filenames
+    ]
+    texts = []
+    for initial_filename, same in zip(initial_filenames, same_blob):
+        final_filename, _, _ = generate_filenames(initial_filename)
+        texts.append(read_text(initial_filename))
+        if not same:
+            texts.append(read_text(final_filename))
+    conference_dir = os.path.dirname(os.path.dirname(initial_filenames[0]))
+    tokens = iter(
+        scc_tokenize_lib.tokenize_cached(
+            texts,
+            get_token_cache(conference_dir, tokenizer, by_paragraph, jobs)))
 
-        if not os.path.isfile(diff_file):
-            d = DocumentDiff(get_tokens(initial_filename),
-                             get_tokens(final_filename), forum)
-            with open(diff_file, 'w') as f:
-                f.write(d.dump())
+    for initial_filename, same in zip(initial_filenames, same_blob):
+        _, diff_file, forum = generate_filenames(initial_filename)
+        initial_tokens = next(tokens)
+        final_tokens = initial_tokens if same else next(tokens)
+        d = DocumentDiff(initial_tokens, final_tokens, forum, matcher=matcher)
+        scc_lib.write_file_atomically(diff_file, d.dump())
+
+
+def extract_diffs(initial_filename,
+                  tokenizer=scc_tokenize_lib.STANZA,
+                  by_paragraph=False,
+                  jobs=1,
+                  matcher=scc_diff_lib.DIFFLIB):
+    extract_diffs_batch([initial_filename], tokenizer, by_paragraph, jobs,
+                        matcher)
+
+
+def main():
+    args = parser.parse_args()
+    initial_filenames = [
+        initial_filename for initial_filename in glob.glob(
+            f"{args.data_dir}/{args.conference}/*/initial.txt")
+        if not os.path.isfile(generate_filenames(initial_filename)[1])
+    ]
+    for start in tqdm.tqdm(range(0, len(initial_filenames), args.batch_size)):
+        extract_diffs_batch(initial_filenames[start:start + args.batch_size],
+                            args.tokenizer, args.by_paragraph, args.jobs,
+                            args.matcher)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+"""Split review texts in metadata.json files into sentences.
+
+00_get_revisions.py only stores the raw text of each review, so that the
+network-bound fetch never waits on stanza. This pass fills in the `sentences'
+field, sentencizing many reviews per stanza call. It can run while the fetch
+is still going; forums whose reviews are already split are skipped.
+"""
+
+import argparse
+import glob
+import json
+import tqdm
+
+import scc_lib
+import scc_tokenize_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument(
+    "-d",
+    "--data_dir",
+    default="forums/",
+    type=str,
+    help="Data dir",
+)
+parser.add_argument("-c",
+                    "--conference",
+                    type=str,
+                    choices=scc_lib.Conference.ALL,
+                    help="conference_year, e.g. iclr_2022",
+                    required=True)
+parser.add_argument("-b",
+                    "--batch_size",
+                    default=256,
+                    type=int,
+                    help="number of reviews per stanza call")
+parser.add_argument("-t",
+                    "--tokenizer",
+                    default=scc_tokenize_lib.STANZA,
+                    choices=scc_tokenize_lib.TOKENIZERS,
+                    help="regex is faster, stanza segments sentences better")
+
+
+def unsentencized_reviews(obj):
+    return [review for review in obj['reviews'] if review['sentences'] is None]
+
+
+def sentencize_metadata_batch(batch, tokenizer=scc_tokenize_lib.STANZA):
+    reviews = sum((unsentencized_reviews(obj) for _, obj in batch), [])
+    for review, sentences in zip(
+            reviews,
+            scc_tokenize_lib.sentencize_batch(
+                [review['text'] for review in reviews], tokenizer)):
+        review['sentences'] = sentences
+
+    for filename, obj in batch:
+        scc_lib.write_file_atomically(filename, json.dumps(obj, indent=2))
+
+
+def main():
+    args = parser.parse_args()
+
+    batch = []
+    batch_reviews = 0
+    for metadata_filename in tqdm.tqdm(
+            list(
+                glob.glob(
+                    f"{args.data_dir}/{args.conference}/*/metadata.json"))):
+        with open(metadata_filename, 'r') as f:
+            obj = json.load(f)
+        num_reviews = len(unsentencized_reviews(obj))
+        if not num_reviews:
+            continue
+        batch.append((metadata_filename, obj))
+        batch_reviews += num_reviews
+        if batch_reviews >= args.batch_size:
+            sentencize_metadata_batch(batch, args.tokenizer)
+            batch = []
+            batch_reviews = 0
+
+    if batch:
+        sentencize_metadata_batch(batch, args.tokenizer)
+
+
+if __name__ == "__main__":
+    main()
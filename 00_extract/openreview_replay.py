@@ -0,0 +1 @@
+../openreview_replay.py
\ No newline at end of file
@@ -24,10 +24,17 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 Module dependencies
 """
 import sys
+import concurrent.futures
+import re
 import string
+import signal
 import subprocess
 import os.path
 import tempfile
+import time
+import functools
+import io
+import shutil
 """
 Global declarations
 """
@@ -54,6 +61,12 @@ diffViewers = [
 # pdftotext program with switches
 pdftotextProgram = "pdftotext"
 pdftotextOptions = "-nopgbrk -enc UTF-8"
+# Same, but keeping the form feeds that end each page
+pdftotextPageOptions = "-enc UTF-8"
+pdfinfoProgram = "pdfinfo"
+
+# Large pdfs are converted in page ranges of at least this many pages
+minPagesPerJob = 8
 
 # Myname
 progName = "pdfdiff.py"
@@ -107,14 +120,28 @@ def get_viewer_list():
     return map(lambda s: (s.split())[0], diffViewers)
 
 
+class ToolNotFoundError(Exception):
+    """
+    Raised by the library functions when a required program is missing.
+    """
+
+
+class ConversionError(Exception):
+    """
+    Raised by the library functions when a conversion produced no output.
+    """
+
+
+@functools.lru_cache(maxsize=None)
 def is_command_available(prg):
     """
     Detect whether prg exists. Note that it may have switches, i.e.
     it will find "kdiff3 -a"
+
+    The result is cached, so each program is only looked up once per
+    process.
     """
-    cmd = "which %s" % ((prg.split())[0])
-    status, out = subprocess.getstatusoutput(cmd)
-    return status == 0
+    return shutil.which((prg.split())[0]) is not None
 
 
 def find_first(plist):
@@ -156,30 +183,14 @@ def make_prefix(fname):
 
 def get_filetype(filename):
     """
-    Determine the filetype.
+    Determine the filetype from the magic bytes at the start of the file.
     """
-    if is_command_available("file"):
-        # On systems where we have 'file', this is a nice
-        # and solid solution.
-        cmd = 'file --brief "%s"' % filename
-        output = subprocess.getoutput(cmd)
-        type = (output.split())[0].lower()
-    else:
-        # If we don't have 'file', we just take an educated
-        # guess based on the filename extension.
-        (head, tail) = os.path.split(filename)
-        (root, ext) = os.path.splitext(tail)
-        type = ext.lower()
-        if type.startswith("."):
-            type = type[1:]
-
-    # Case distinctions for possible results.
-    #
-    # Be aware we might be matching either the output from 'file' or the
-    # extension!
-    if type in ["pdf", "fdf"]:
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+
+    if magic == b"%PDF":
         return "pdf"
-    elif type in ["postscript", "ps"]:
+    elif magic.startswith(b"%!"):
         return "ps"
     else:
         # Default assumption: text
@@ -236,38 +247,54 @@ def is_sentence_done(sentence):
     return False
 
 
-def flush_sentence(fout, forceNewLine=False):
-    """
-    Flush the sentence buffer.
-    """
-    global sentenceBuf
-    global lastWordLength
-
-    lastWordLength = 0
-    l = sentenceBuf.lstrip()
-    l = fix_ff_problem(l)
-    fout.write(l)
-    if forceNewLine or (sentenceBuf != ""):
-        fout.write("\n")
-    sentenceBuf = ""
-
-
-def normalize_text(fin, fout):
-    """
-    Normalize the lines read from fin, and output to fout, which
-    are file handles.
-    """
-    global sentenceBuf
-    global lastWordLength
-
-    sentenceBuf = ""  # stores unfinished sentences
-    wordLength = 0
-    lastWordLength = 0
-    skipEnds = False
-
-    # Alternatively, we could use xreadlines, if the files are really
-    # really huge.
-    for l in fin.readlines():
+class TextNormalizer(object):
+    """
+    Streaming version of the normalization: feed it lines, and it yields
+    normalized lines. All state is kept in the object, so several
+    normalizers can run at the same time (e.g. in threads).
+
+    Sentences are kept as a list of pieces plus their total length, and
+    lines are scanned one run of characters at a time; a sentence can only
+    end at a punctuation character, so only those are checked. This makes
+    the normalization linear in the length of the input.
+    """
+
+    # Runs of letters, single punctuation characters, and runs of anything
+    # else.
+    tokenPattern = re.compile("([%s]+)|([%s])|([^%s%s]+)" % (
+        re.escape(string.ascii_letters),
+        re.escape(string.punctuation),
+        re.escape(string.ascii_letters),
+        re.escape(string.punctuation),
+    ))
+
+    def __init__(self):
+        self.sentence = []  # pieces of the unfinished sentence
+        self.sentenceLength = 0
+        self.wordLength = 0
+        self.lastWordLength = 0
+        self.skipEnds = False
+
+    def flush(self, forceNewLine=False):
+        """
+        Flush the sentence buffer, returning the output line (if any).
+        """
+        sentence = "".join(self.sentence)
+        self.sentence = []
+        self.sentenceLength = 0
+        self.lastWordLength = 0
+        if forceNewLine or (sentence != ""):
+            return fix_ff_problem(sentence.lstrip()) + "\n"
+        return None
+
+    def append(self, piece):
+        self.sentence.append(piece)
+        self.sentenceLength += len(piece)
+
+    def feed(self, l):
+        """
+        Normalize one input line, yielding any finished output lines.
+        """
         # Cut of spacing from both ends
         ls = l.strip()
 
@@ -278,40 +305,92 @@ def normalize_text(fin, fout):
             #
             # Any further additional empty lines have no effect,
             # which is enforced by skipEnds.
-            if not skipEnds:
-                flush_sentence(fout)
-                flush_sentence(fout, True)
-                skipEnds = True
-        else:
-            # The file line is not empty, so this is some sort of
-            # paragraph
-            skipEnds = False
-            if sentenceBuf != "":
-                if not sentenceBuf[-1] in string.whitespace:
-                    sentenceBuf += " "
-
-            for c in ls:
-                # Append the character to the current buffer.
-                sentenceBuf += c
-
+            if not self.skipEnds:
+                for forceNewLine in (False, True):
+                    line = self.flush(forceNewLine)
+                    if line is not None:
+                        yield line
+                self.skipEnds = True
+            return
+
+        # The file line is not empty, so this is some sort of
+        # paragraph
+        self.skipEnds = False
+        if self.sentence and not self.sentence[-1][-1] in string.whitespace:
+            self.append(" ")
+
+        for match in self.tokenPattern.finditer(ls):
+            letters, c, other = match.groups()
+            if letters is not None:
                 # Some admin to know how long the last word was.
-                if c in string.ascii_letters:
-                    wordLength += 1
-                    lastWordLength = wordLength
-                else:
-                    wordLength = 0
-
-                if is_sentence_done(sentenceBuf):
+                self.append(letters)
+                self.wordLength += len(letters)
+                self.lastWordLength = self.wordLength
+            elif other is not None:
+                self.append(other)
+                self.wordLength = 0
+            else:
+                self.append(c)
+                self.wordLength = 0
+                if is_sentence_end(c) or (self.sentenceLength
+                                          >= longSentenceLength):
                     # If the last word is only a single character,
                     # it's assumed that the punctuation does not
                     # refer to a sentence end.
-                    if lastWordLength != 1:
+                    if self.lastWordLength != 1:
                         # Sentence has ended, so flush it.
-                        # We should skip any spacing directly after
-                        # the sentence end mark.
-                        flush_sentence(fout)
+                        yield self.flush()
+
+    def close(self):
+        """
+        Yield whatever is left in the sentence buffer.
+        """
+        line = self.flush()
+        if line is not None:
+            yield line
+
+    def normalize(self, lines):
+        """
+        Normalize an iterable of lines, yielding normalized lines.
+        """
+        for l in lines:
+            yield from self.feed(l)
+        yield from self.close()
+
+
+def normalize_pages(pages):
+    """
+    Normalize the text of consecutive pages, yielding (page index, line)
+    pairs. The lines are the same as for the concatenated pages; each is
+    tagged with the page on which it was finished.
+    """
+    normalizer = TextNormalizer()
+    carry = ""  # unfinished last line of the previous page
+    page = -1
+    for page, text in enumerate(pages):
+        for l in io.StringIO(carry + text):
+            if l.endswith("\n"):
+                for line in normalizer.feed(l):
+                    yield page, line
+                carry = ""
+            else:
+                carry = l
+
+    last = max(page, 0)
+    if carry:
+        for line in normalizer.feed(carry):
+            yield last, line
+    for line in normalizer.close():
+        yield last, line
+
 
-    flush_sentence(fout)
+def normalize_text(fin, fout):
+    """
+    Normalize the lines read from fin, and output to fout, which
+    are file handles.
+    """
+    for line in TextNormalizer().normalize(fin):
+        fout.write(line)
     fout.flush()
 
 
@@ -320,14 +399,59 @@ def normalize_text(fin, fout):
 # -------------------------------------------------------------------------
 
 
-def ps_to_pdf(filename, prefix=""):
+def deadline_after(timeout):
+    """
+    Deadline (in time.monotonic() seconds) for a conversion that may take
+    timeout seconds in all, or None for no limit.
+    """
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+def time_left(deadline, cmd):
+    """
+    Seconds left until the deadline, or None for no limit. Raises
+    subprocess.TimeoutExpired if the deadline has passed before cmd starts.
+    """
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise subprocess.TimeoutExpired(cmd, 0)
+    return left
+
+
+def run_command(cmd, deadline=None):
+    """
+    Like subprocess.run(cmd, capture_output=True), but stops at the deadline.
+    The command runs in its own process group, which is killed as a whole, so
+    that programs it starts itself (ps2pdf runs gs) are stopped too.
+    """
+    timeout = time_left(deadline, cmd)
+    proc = subprocess.Popen(cmd,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            start_new_session=True)
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except BaseException:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.communicate()
+        raise
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+def ps_to_pdf(filename, prefix="", timeout=None):
     """
     ps to pdf conversion
     """
     prg = "ps2pdf"
     notfound = "Could not find 'ps2pdf', which is needed for ps to pdf conversion."
-    (fout, output) = apply_command_temp(prg, "", notfound, filename, prefix,
-                                        ".pdf")
+    if not is_command_available(prg):
+        raise ToolNotFoundError(notfound)
+    fout = tempfile.NamedTemporaryFile(mode="w+", suffix=".pdf", prefix=prefix)
+    run_command([prg, filename, fout.name], deadline_after(timeout))
     return fout
 
 
@@ -350,6 +474,157 @@ Could not find '%s', which is needed for pdf to text conversion.
     return fout
 
 
+def pdf_to_text_string(filename, timeout=None):
+    """
+    pdf to text conversion through a pipe, without a temporary file.
+    Raises subprocess.TimeoutExpired if pdftotext takes longer than timeout
+    seconds.
+    """
+    global pdftotextProgram, pdftotextOptions
+
+    if not is_command_available(pdftotextProgram):
+        raise ToolNotFoundError(
+            "Could not find '%s', which is needed for pdf to text conversion."
+            % pdftotextProgram)
+
+    cmd = [pdftotextProgram] + pdftotextOptions.split() + [filename, "-"]
+    result = run_command(cmd, deadline_after(timeout))
+    if result.returncode != 0 and not result.stdout:
+        raise ConversionError(result.stderr.decode("utf-8", errors="replace"))
+    return result.stdout.decode("utf-8", errors="replace")
+
+
+def pdf_page_count(filename, deadline=None):
+    """
+    Number of pages according to pdfinfo, or None if it is not known.
+    """
+    global pdfinfoProgram
+
+    if not is_command_available(pdfinfoProgram):
+        return None
+    result = run_command([pdfinfoProgram, filename], deadline)
+    for line in result.stdout.decode("utf-8", errors="replace").splitlines():
+        if line.startswith("Pages:"):
+            return int(line.split()[1])
+    return None
+
+
+def pdf_to_pages(filename, timeout=None, jobs=1):
+    """
+    pdf to text conversion that keeps page boundaries: return a list with
+    the text of each page. Joined together, the pages are the text that
+    pdf_to_text_string returns. With jobs > 1, large pdfs are converted in
+    page ranges by several pdftotext processes at once. The timeout is for
+    the whole conversion, not for each process.
+    """
+    global pdftotextProgram, pdftotextPageOptions, minPagesPerJob
+
+    deadline = deadline_after(timeout)
+    if not is_command_available(pdftotextProgram):
+        raise ToolNotFoundError(
+            "Could not find '%s', which is needed for pdf to text conversion."
+            % pdftotextProgram)
+
+    ranges = [[]]
+    if jobs > 1:
+        pageCount = pdf_page_count(filename, deadline)
+        if pageCount is not None and pageCount >= 2 * minPagesPerJob:
+            size = max(minPagesPerJob, -(-pageCount // jobs))
+            ranges = [[
+                "-f",
+                str(first), "-l",
+                str(min(first + size - 1, pageCount))
+            ] for first in range(1, pageCount + 1, size)]
+
+    def convert(pageRange):
+        cmd = ([pdftotextProgram] + pdftotextPageOptions.split() + pageRange +
+               [filename, "-"])
+        result = run_command(cmd, deadline)
+        if result.returncode != 0 and not result.stdout:
+            raise ConversionError(
+                result.stderr.decode("utf-8", errors="replace"))
+        return result.stdout.decode("utf-8", errors="replace")
+
+    with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+        texts = list(executor.map(convert, ranges))
+
+    pages = []
+    for text in texts:
+        # Every page ends with a form feed
+        rangePages = text.split("\f")
+        if rangePages[-1] == "":
+            rangePages.pop()
+        pages += rangePages
+    return pages
+
+
+def normalize_file_pages(filename, timeout=None, jobs=1):
+    """
+    Page-aware version of normalize_file_lines: return the number of pages
+    and an iterator over (page index, normalized line) pairs. Files that are
+    not pdf are treated as a single page. The timeout is for all conversions of the file together.
+    """
+    filetype = get_filetype(filename)
+    deadline = deadline_after(timeout)
+
+    temphandle = None
+    if filetype == "ps":
+        temphandle = ps_to_pdf(filename,
+                               prefix=make_prefix(filename),
+                               timeout=timeout)
+        filename = temphandle.name
+        filetype = get_filetype(filename)
+
+    if filetype == "pdf":
+        pages = pdf_to_pages(filename, time_left(deadline, pdftotextProgram),
+                             jobs)
+    else:
+        with open(filename, "r") as f:
+            pages = [f.read()]
+
+    if temphandle:
+        temphandle.close()
+
+    return len(pages), normalize_pages(pages)
+
+
+def normalize_file(filename, timeout=None):
+    """
+    Library version of normalize_anything: return the normalized text of a
+    pdf, ps or txt file as a string. Apart from pdftotext (and ps2pdf for ps
+    files), no other processes are started.
+    """
+    return "".join(normalize_file_lines(filename, timeout))
+
+
+def normalize_file_lines(filename, timeout=None):
+    """
+    Like normalize_file, but return an iterator over the normalized lines.
+    """
+    filetype = get_filetype(filename)
+    deadline = deadline_after(timeout)
+
+    temphandle = None
+    if filetype == "ps":
+        temphandle = ps_to_pdf(filename,
+                               prefix=make_prefix(filename),
+                               timeout=timeout)
+        filename = temphandle.name
+        filetype = get_filetype(filename)
+
+    if filetype == "pdf":
+        text = pdf_to_text_string(filename,
+                                  time_left(deadline, pdftotextProgram))
+    else:
+        with open(filename, "r") as f:
+            text = f.read()
+
+    if temphandle:
+        temphandle.close()
+
+    return TextNormalizer().normalize(io.StringIO(text))
+
+
 def normalize_anything(filename, fout=sys.stdout):
     """
     This function takes any file type and tries to apply converters
@@ -516,12 +791,16 @@ if __name__ == "__main__":
 
         else:
             # Default mode: 1 argument is normalize, 2 is diff
-            if len(args) == 1:
-                normalize_anything(args[0])
-                sys.exit(0)
-            elif len(args) == 2:
-                view_diff(args[0], args[1])
-                sys.exit(0)
+            try:
+                if len(args) == 1:
+                    normalize_anything(args[0])
+                    sys.exit(0)
+                elif len(args) == 2:
+                    view_diff(args[0], args[1])
+                    sys.exit(0)
+            except ToolNotFoundError as e:
+                print("Error: %s" % e)
+                sys.exit(1)
             else:
                 print(
                     "Error: I don't know what to do with more than two files")
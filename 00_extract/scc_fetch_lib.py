@@ -0,0 +1,351 @@
+"""Helpers for fetching forums from the OpenReview API concurrently.
+
+All workers share one token bucket, so the request rate to the API is bounded
+no matter how many forums are in flight. When the API signals throttling, the
+bucket halves its rate and the call is retried with exponential backoff; the
+rate then creeps back up as calls succeed.
+"""
+
+import concurrent.futures
+import csv
+import json
+import os
+import random
+import threading
+import time
+import zlib
+
+import openreview
+
+import openreview_replay
+
+DEFAULT_RATE = 5.0  # requests per second
+MIN_RATE = 0.2
+RECOVERY_FACTOR = 1.05
+
+MAX_RETRIES = 8
+INITIAL_BACKOFF = 1.0  # seconds
+MAX_BACKOFF = 60.0
+
+PAGE_SIZE = 1000  # API maximum
+
+FSYNC_EVERY = 50  # records
+FSYNC_INTERVAL = 10.0  # seconds
+
+STATUS_FIELDS = "#Conference Forum Status Decision".split()
+
+THROTTLING_ERROR_NAMES = ["RateLimitError", "TooManyRequestsError"]
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate=DEFAULT_RATE):
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.max_rate = rate
+            self.rate = rate
+            self.capacity = max(1.0, rate)
+            self.tokens = self.capacity
+            self.last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(MIN_RATE, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate * RECOVERY_FACTOR)
+
+
+def is_throttling_error(e):
+    error = e.args[0] if e.args else None
+    if not isinstance(error, dict):
+        return False
+    return (error.get("name") in THROTTLING_ERROR_NAMES
+            or error.get("status") == 429
+            or "too many requests" in str(error.get("message", "")).lower())
+
+
+def call_with_backoff(bucket, function, *args, **kwargs):
+    """Call an OpenReview client method under the rate limit.
+
+    Throttling errors are retried with jittered exponential backoff; any other
+    OpenReviewException is passed on to the caller.
+    """
+    delay = INITIAL_BACKOFF
+    for attempt in range(MAX_RETRIES):
+        bucket.acquire()
+        try:
+            result = function(*args, **kwargs)
+        except openreview.OpenReviewException as e:
+            if not is_throttling_error(e) or attempt == MAX_RETRIES - 1:
+                raise
+            bucket.slow_down()
+            time.sleep(delay * (1 + random.random()))
+            delay = min(MAX_BACKOFF, delay * 2)
+        else:
+            bucket.speed_up()
+            return result
+
+
+def probe_pdf_status(client, reference_id):
+    """HTTP status of a reference PDF request, without reading its body."""
+    if hasattr(client, "probe_pdf_status"):  # Record/replay clients
+        return client.probe_pdf_status(reference_id)
+    response = client.session.get(client.pdf_revisions_url,
+                                  params={'id': reference_id},
+                                  headers=client.headers,
+                                  stream=True)
+    with response:  # Closing before reading the body skips the download
+        return response.status_code
+
+
+def stream_pdf(client, reference_id, chunk_size=openreview_replay.CHUNK_SIZE):
+    """Yield the body of a reference PDF in chunks.
+
+    Errors are raised as the OpenReviewException that client.get_pdf would
+    raise.
+    """
+    if hasattr(client, "stream_pdf"):  # Record/replay clients
+        yield from client.stream_pdf(reference_id, chunk_size)
+        return
+    with client.session.get(client.pdf_revisions_url,
+                            params={'id': reference_id},
+                            headers=client.headers,
+                            stream=True) as response:
+        if not response.ok:
+            raise openreview.OpenReviewException(
+                openreview_replay.error_from_response(response))
+        yield from response.iter_content(chunk_size)
+
+
+def count_notes(bucket, client, **params):
+    _, count = call_with_backoff(bucket,
+                                 client.get_notes,
+                                 limit=1,
+                                 with_count=True,
+                                 **params)
+    return count
+
+
+def iter_notes(bucket, client, page_size=PAGE_SIZE, **params):
+    """Yield notes one page at a time instead of loading them all up front.
+    """
+    offset = 0
+    while True:
+        page = call_with_backoff(bucket,
+                                 client.get_notes,
+                                 offset=offset,
+                                 limit=page_size,
+                                 **params)
+        yield from page
+        if len(page) < page_size:
+            return
+        offset += len(page)
+
+
+def map_unordered(function, items, jobs, on_abandoned=None):
+    """Apply function to each item on `jobs` threads, yielding (item, result).
+
+    Results are yielded in completion order. At most 2 * jobs items are in
+    flight at any time, so `items` may be a lazy iterator.
+
+    If the consumer stops early (e.g. --debug) or a call raises, items that
+    have not started are cancelled and those already running are waited for.
+    Their side effects happen anyway, so each one that succeeded is passed to
+    on_abandoned(item, result) instead of being dropped. The consumer should
+    close() the generator when it stops early, so this happens right away.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    pending = {}
+    items = iter(items)
+    try:
+        while True:
+            for item in items:
+                pending[executor.submit(function, item)] = item
+                if len(pending) >= 2 * jobs:
+                    break
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if on_abandoned is not None:
+            for future, item in pending.items():
+                if not future.cancelled() and future.exception() is None:
+                    on_abandoned(item, future.result())
+
+
+class ReferenceCache(object):
+    """Persistent record of what each reference's PDF request returned.
+
+    Entries are keyed by reference id and modification time, so an edited
+    reference is looked up afresh. The backing file is append-only JSON lines;
+    a torn last line from a killed run is ignored on load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        line = ""
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        obj = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        continue
+                    self.entries[(obj["id"], obj["tmdate"])] = (obj["status"],
+                                                                obj["sha256"])
+        self.f = open(path, 'a')
+        if self.f.tell() and not line.endswith("\n"):
+            self.f.write("\n")  # Terminate the torn line
+
+    @staticmethod
+    def key(reference):
+        return (reference.id, reference.tmdate or reference.tcdate)
+
+    def get(self, reference):
+        """Return (pdf_status, sha256) or None if never fetched."""
+        with self.lock:
+            return self.entries.get(self.key(reference))
+
+    def put(self, reference, status, digest):
+        reference_id, tmdate = self.key(reference)
+        with self.lock:
+            self.entries[(reference_id, tmdate)] = (status, digest)
+            self.f.write(
+                json.dumps({
+                    "id": reference_id,
+                    "tmdate": tmdate,
+                    "status": status,
+                    "sha256": digest
+                }) + "\n")
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class StatusJournal(object):
+    """Append-only, crash-safe log of the status of each processed forum.
+
+    Each record is one line holding a CRC32 of its payload, so a record torn
+    by a killed job (or padded with '\0' bytes by the filesystem) is detected
+    and dropped on load instead of corrupting the statuses. Records are
+    fsynced in batches. All finished forums are loaded into memory in one pass
+    at startup, and the journal can be compacted into the status TSV format.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}  # forum id -> [conference, forum, status, decision]
+        ends_with_newline = True
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    ends_with_newline = line.endswith(b'\n')
+                    row = self._unframe(line)
+                    if row is not None:
+                        self.rows[row[1]] = row
+        self.f = open(path, 'ab')
+        if not ends_with_newline:
+            self.f.write(b'\n')  # Terminate the torn record
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    @staticmethod
+    def _frame(row):
+        payload = json.dumps(row).encode()
+        return b'%08x\t%s\n' % (zlib.crc32(payload), payload)
+
+    @staticmethod
+    def _unframe(line):
+        if not line.endswith(b'\n'):
+            return None
+        checksum, _, payload = line[:-1].partition(b'\t')
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def __contains__(self, forum_id):
+        return forum_id in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, conference, forum_id, status, decision):
+        row = [conference, forum_id, status, decision]
+        self.rows[forum_id] = row
+        self.f.write(self._frame(row))
+        self.unsynced += 1
+        if (self.unsynced >= FSYNC_EVERY
+                or time.monotonic() - self.last_sync > FSYNC_INTERVAL):
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def import_tsv(self, tsv_path):
+        """Seed the journal with the rows of an existing status TSV."""
+        with open(tsv_path, 'r') as f:
+            reader = csv.DictReader((x.replace('\0', '') for x in f),
+                                    delimiter='\t')
+            for row in reader:
+                if row["Forum"] and row["Forum"] not in self.rows:
+                    self.append(*[row[field] for field in STATUS_FIELDS])
+        self.sync()
+
+    def compact(self, tsv_path):
+        """Atomically rewrite tsv_path with one row per forum."""
+        temp_path = f'{tsv_path}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write("\t".join(STATUS_FIELDS) + "\n")
+            for row in self.rows.values():
+                f.write("\t".join(row) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, tsv_path)
+
+    def close(self):
+        self.sync()
+        self.f.close()
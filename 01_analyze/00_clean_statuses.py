@@ -3,6 +3,7 @@ import collections
 import csv
 import openreview
 
+import openreview_replay
 import scc_lib
 
 parser = argparse.ArgumentParser(description="")
@@ -20,6 +21,13 @@ parser.add_argument(
     type=str,
     help="Status dir",
 )
+parser.add_argument('--record',
+                    type=str,
+                    help='record all API responses into this directory')
+parser.add_argument('--replay',
+                    type=str,
+                    help='serve API responses recorded with --record '
+                    'instead of using the network')
 
 VALID_DECISIONS = [
     "Accept: notable-top-25%", "Accept: notable-top-5%", "Accept (Oral)",
@@ -28,7 +36,14 @@ VALID_DECISIONS = [
     "None", "Reject"
 ]
 
-GUEST_CLIENT = openreview.Client(baseurl='https://api.openreview.net')
+GUEST_CLIENT = None  # Created on first use, see get_guest_client
+
+
+def get_guest_client():
+    global GUEST_CLIENT
+    if GUEST_CLIENT is None:
+        GUEST_CLIENT = openreview.Client(baseurl='https://api.openreview.net')
+    return GUEST_CLIENT
 
 
 def find_actual_decision(forum, conference, bad_decision):
@@ -37,7 +52,7 @@ def find_actual_decision(forum, conference, bad_decision):
     ]
     return "None"
     dec = None
-    for note in GUEST_CLIENT.get_notes(forum=forum):
+    for note in get_guest_client().get_notes(forum=forum):
         if 'Decision' in note.invitation:
             dec = note.content['decision']
             break
@@ -46,7 +61,14 @@ def find_actual_decision(forum, conference, bad_decision):
 
 
 def main():
+    global GUEST_CLIENT
+
     args = parser.parse_args()
+    if args.replay:
+        GUEST_CLIENT = openreview_replay.ReplayClient(args.replay)
+    elif args.record:
+        GUEST_CLIENT = openreview_replay.RecordingClient(
+            get_guest_client(), args.record)
     counts = collections.Counter()
     final_lines = []
     for conference in scc_lib.Conference.ALL:
@@ -152,10 +152,8 @@ def process_diffs(obj, forum, file_handles, section_map):
         file_handles[diff_type].write(json.dumps(augmented_diff) + "\n")
 
 
-def main():
-    args = parser.parse_args()
-
-    reduced_diffs_path = f"{args.data_dir}/{args.conference}/reduced_diffs/"
+def write_reduced_diffs(data_dir, conference):
+    reduced_diffs_path = f"{data_dir}/{conference}/reduced_diffs/"
     os.makedirs(reduced_diffs_path, exist_ok=True)
     print(reduced_diffs_path)
     file_handles = {}
@@ -164,8 +162,7 @@ def main():
                                       'w')
 
     for filename in tqdm.tqdm(
-            list(
-                glob.glob(f"{args.data_dir}/{args.conference}/*/diffs.json"))):
+            list(glob.glob(f"{data_dir}/{conference}/*/diffs.json"))):
         with open(filename, 'r') as f:
             try:
                 forum = filename.split('/')[-2]
@@ -180,5 +177,10 @@ def main():
         handle.close()
 
 
+def main():
+    args = parser.parse_args()
+    write_reduced_diffs(args.data_dir, args.conference)
+
+
 if __name__ == "__main__":
     main()
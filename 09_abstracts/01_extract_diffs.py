@@ -1,30 +1,48 @@
+import argparse
 import json
-import stanza
 import tqdm
 
 import scc_diff_lib
+import scc_tokenize_lib
 
-SENTENCIZE_PIPELINE = stanza.Pipeline("en", processors="tokenize")
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-t",
+                    "--tokenizer",
+                    default=scc_tokenize_lib.STANZA,
+                    choices=scc_tokenize_lib.TOKENIZERS,
+                    help="regex is faster, stanza segments sentences better")
+parser.add_argument("-m",
+                    "--matcher",
+                    default=scc_diff_lib.DIFFLIB,
+                    choices=scc_diff_lib.MATCHERS,
+                    help="how to find matching blocks")
 
-def get_tokens(text):
-    return list([t.to_dict()[0]['text'] for t in s.tokens]
-                    for s in SENTENCIZE_PIPELINE(text).sentences)
+KEYS = ['abstract', 'intro']
 
 
 def main():
+    args = parser.parse_args()
+    token_cache = scc_tokenize_lib.TokenCache(scc_tokenize_lib.TOKEN_CACHE_DIR,
+                                              args.tokenizer)
 
     diffs = []
     with open('diffs.jsonl','w') as g:
         with open('abstract_intro_versions.jsonl', 'r') as f:
             for line in tqdm.tqdm(f.readlines()):
                 obj = json.loads(line)
-                for key in ['abstract', 'intro']:
-                    d = scc_diff_lib.DocumentDiff(
-                        get_tokens(obj['initial_info'][key]),
-                        get_tokens(obj['final_info'][key]),
-                        f"{get_tokens(obj['forum_id'])}_{key}")
+                # Tokenize all texts of the forum in one call
+                texts = [obj['forum_id']]
+                for key in KEYS:
+                    texts += [obj['initial_info'][key], obj['final_info'][key]]
+                tokens = iter(
+                    scc_tokenize_lib.tokenize_cached(texts, token_cache))
+                forum_tokens = next(tokens)
+                for key in KEYS:
+                    d = scc_diff_lib.DocumentDiff(next(tokens),
+                                                  next(tokens),
+                                                  f"{forum_tokens}_{key}",
+                                                  matcher=args.matcher)
                     g.write(d.dump())
 
 if __name__ == "__main__":
-  main()
-
+    main()
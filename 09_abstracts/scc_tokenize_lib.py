@@ -0,0 +1 @@
+../scc_tokenize_lib.py
\ No newline at end of file
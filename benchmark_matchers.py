@@ -0,0 +1,119 @@
+"""Compare the engines for finding matching blocks in scc_diff_lib.
+
+Diffs initial.txt against final.txt for every forum under the examples
+directory with each matcher, and reports the time taken to find matching
+blocks and to compute the whole DocumentDiff, along with the sizes of the
+nonmatching blocks left for Myers. Blocks longer than scc_diff_lib.MAX_LEN
+tokens are not diffed by Myers but turned into one large diff.
+
+The example revisions are mostly rewrites, so each final text is also diffed
+against a copy with small random edits in some of its sentences (rows marked
+"+edits"), which is closer to a typical camera-ready revision.
+"""
+
+import argparse
+import glob
+import random
+import time
+
+import scc_diff_lib
+import scc_tokenize_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-e",
+                    "--examples_dir",
+                    default="examples/",
+                    type=str,
+                    help="directory of forum directories with text files")
+parser.add_argument("-t",
+                    "--tokenizer",
+                    default=scc_tokenize_lib.REGEX,
+                    choices=scc_tokenize_lib.TOKENIZERS,
+                    help="tokenizer to diff the texts with")
+parser.add_argument("-s",
+                    "--edited_sentences",
+                    default=0.1,
+                    type=float,
+                    help="fraction of sentences to edit in the simulated "
+                    "revisions")
+
+
+def simulate_edits(sentences, fraction, rng):
+    """Copy of tokenized sentences with a few tokens replaced in some."""
+    edited = []
+    for sentence in sentences:
+        sentence = list(sentence)
+        if rng.random() < fraction:
+            i = rng.randrange(len(sentence) + 1)
+            sentence[i:i + rng.randint(0, 3)] = [
+                f"edit{rng.randint(0, 9)}" for _ in range(rng.randint(0, 4))
+            ]
+        edited.append(sentence)
+    return edited
+
+
+def measure(initial_tokens, final_tokens, forum, matcher):
+    """Return seconds for matching blocks and the whole diff, and the diff."""
+    vocabulary = scc_diff_lib.TokenVocabulary()
+    source_ids = vocabulary.encode(sum(initial_tokens, []))
+    dest_ids = vocabulary.encode(sum(final_tokens, []))
+    start = time.perf_counter()
+    scc_diff_lib.get_matching_blocks(source_ids, dest_ids, matcher)
+    match_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    d = scc_diff_lib.DocumentDiff(initial_tokens,
+                                  final_tokens,
+                                  forum,
+                                  matcher=matcher)
+    return match_seconds, time.perf_counter() - start, d
+
+
+def main():
+    args = parser.parse_args()
+    initial_filenames = sorted(glob.glob(f"{args.examples_dir}/*/initial.txt"))
+    texts = []
+    for initial_filename in initial_filenames:
+        final_filename = initial_filename[:-11] + "final.txt"
+        for filename in [initial_filename, final_filename]:
+            with open(filename, 'r') as f:
+                texts.append(f.read())
+    tokens = scc_tokenize_lib.tokenize_batch(texts, args.tokenizer)
+    rng = random.Random(0)
+    pairs = []
+    for i, initial_filename in enumerate(initial_filenames):
+        forum = initial_filename.split("/")[-2]
+        pairs.append((forum, tokens[2 * i], tokens[2 * i + 1]))
+        pairs.append((f"{forum}+edits", tokens[2 * i + 1],
+                      simulate_edits(tokens[2 * i + 1], args.edited_sentences,
+                                     rng)))
+
+    print(f"{'forum':18s}{'matcher':11s}{'match s':>9s}{'diff s':>9s}"
+          f"{'blocks':>8s}{'largest':>9s}{'> max':>7s}{'diffs':>7s}"
+          f"{'changed':>9s}{'valid':>7s}")
+    totals = {matcher: [0.0, 0.0] for matcher in scc_diff_lib.MATCHERS}
+    for forum, source_tokens, dest_tokens in pairs:
+        for matcher in scc_diff_lib.MATCHERS:
+            match_seconds, diff_seconds, d = measure(source_tokens,
+                                                     dest_tokens, forum,
+                                                     matcher)
+            totals[matcher][0] += match_seconds
+            totals[matcher][1] += diff_seconds
+            block_lens = [
+                block.l_a + block.l_b for block in d.blocks
+                if isinstance(block, scc_diff_lib.NonMatchingBlock)
+                and block.l_a + block.l_b
+            ]
+            changed = sum(len(diff.old) + len(diff.new) for diff in d.diffs)
+            print(f"{forum:18s}{matcher:11s}{match_seconds:9.2f}"
+                  f"{diff_seconds:9.2f}{len(block_lens):8d}"
+                  f"{max(block_lens, default=0):9d}"
+                  f"{sum(l > scc_diff_lib.MAX_LEN for l in block_lens):7d}"
+                  f"{len(d.diffs):7d}{changed:9d}{str(d.is_valid):>7s}")
+    for matcher in scc_diff_lib.MATCHERS:
+        print(f"{'all':18s}{matcher:11s}{totals[matcher][0]:9.2f}"
+              f"{totals[matcher][1]:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Compare the regex tokenizer with stanza for speed and agreement.
+
+Tokenizes every initial.txt and final.txt under the examples directory with
+both backends and reports throughput, plus how often the regex tokenizer puts
+token and sentence boundaries where stanza does. Boundaries are compared as
+offsets into the text with whitespace removed, so they line up even where the
+two backends split tokens differently.
+"""
+
+import argparse
+import glob
+import time
+
+import scc_tokenize_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-e",
+                    "--examples_dir",
+                    default="examples/",
+                    type=str,
+                    help="directory of forum directories with text files")
+
+
+def boundaries(sentences):
+    """Offsets at which tokens and sentences end, ignoring whitespace."""
+    token_ends = set()
+    sentence_ends = set()
+    offset = 0
+    for sentence in sentences:
+        for token in sentence:
+            offset += len("".join(token.split()))
+            token_ends.add(offset)
+        sentence_ends.add(offset)
+    return token_ends, sentence_ends
+
+
+def f1(reference, predicted):
+    if not reference and not predicted:
+        return 1.0
+    return 2 * len(reference & predicted) / (len(reference) + len(predicted))
+
+
+def time_tokenizer(texts, tokenizer):
+    start = time.perf_counter()
+    results = scc_tokenize_lib.tokenize_batch(texts, tokenizer)
+    return time.perf_counter() - start, results
+
+
+def main():
+    args = parser.parse_args()
+    filenames = sorted(
+        glob.glob(f"{args.examples_dir}/*/initial.txt") +
+        glob.glob(f"{args.examples_dir}/*/final.txt"))
+    texts = []
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            texts.append(f.read())
+    num_chars = sum(len(text) for text in texts)
+
+    scc_tokenize_lib.tokenize_batch(["Load the model first."])  # Not timed
+    seconds = {}
+    results = {}
+    for tokenizer in scc_tokenize_lib.TOKENIZERS:
+        seconds[tokenizer], results[tokenizer] = time_tokenizer(
+            texts, tokenizer)
+
+    print(f"{len(texts)} texts, {num_chars} characters")
+    for tokenizer in scc_tokenize_lib.TOKENIZERS:
+        print(f"{tokenizer:8s}{seconds[tokenizer]:8.2f}s "
+              f"{num_chars / seconds[tokenizer]:12.0f} chars/s")
+    speedup = (seconds[scc_tokenize_lib.STANZA] /
+               seconds[scc_tokenize_lib.REGEX])
+    print(f"speedup {speedup:.1f}x")
+
+    print(f"{'file':40s}{'token F1':>10s}{'sentence F1':>13s}")
+    all_counts = [[set(), set()], [set(), set()]]  # [stanza, regex] x kinds
+    for i, filename in enumerate(filenames):
+        reference = boundaries(results[scc_tokenize_lib.STANZA][i])
+        predicted = boundaries(results[scc_tokenize_lib.REGEX][i])
+        for kind in range(2):
+            # Tag with the file so the overall scores pool all boundaries
+            all_counts[0][kind] |= {(i, x) for x in reference[kind]}
+            all_counts[1][kind] |= {(i, x) for x in predicted[kind]}
+        name = "/".join(filename.split("/")[-2:])
+        print(f"{name:40s}{f1(reference[0], predicted[0]):10.3f}"
+              f"{f1(reference[1], predicted[1]):13.3f}")
+    print(f"{'all':40s}{f1(all_counts[0][0], all_counts[1][0]):10.3f}"
+          f"{f1(all_counts[0][1], all_counts[1][1]):13.3f}")
+
+
+if __name__ == "__main__":
+    main()
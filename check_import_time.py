@@ -0,0 +1,79 @@
+"""Check that the light stage scripts start quickly.
+
+Each script is imported (not run) in a fresh interpreter, from its own
+directory, and the wall time of the whole process is compared to a budget.
+The scripts must also not pull in the tokenizer; stanza and torch are only
+imported by the stages that tokenize, when they first do.
+
+Exits with status 1 if any script is over budget, fails to import, or loads a
+heavy module.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-b",
+                    "--budget",
+                    default=0.5,
+                    type=float,
+                    help="seconds allowed to start each script")
+
+LIGHT_SCRIPTS = [
+    "00_extract/00_get_revisions.py",
+    "00_extract/02_clean_iclr.py",
+    "00_extract/04_sectionize.py",
+    "00_extract/05_process_scores.py",
+    "01_analyze/00_clean_statuses.py",
+    "01_analyze/01_summarize.py",
+]
+HEAVY_MODULES = ["stanza", "torch"]
+
+IMPORT_SNIPPET = """
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location("stage", sys.argv[1])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(" ".join(m for m in sys.argv[2:] if m in sys.modules))
+"""
+
+
+def time_import(script):
+    """Return (seconds, heavy modules loaded, error message or None)."""
+    path = os.path.join(REPO_DIR, script)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET, path] +
+                            HEAVY_MODULES,
+                            cwd=os.path.dirname(path),
+                            capture_output=True,
+                            text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        return seconds, [], result.stderr.strip().splitlines()[-1]
+    return seconds, result.stdout.split(), None
+
+
+def main():
+    args = parser.parse_args()
+    ok = True
+    for script in LIGHT_SCRIPTS:
+        seconds, heavy_modules, error = time_import(script)
+        if error is not None:
+            status = f"error: {error}"
+        elif heavy_modules:
+            status = "imports " + ", ".join(heavy_modules)
+        elif seconds > args.budget:
+            status = "over budget"
+        else:
+            status = "ok"
+        ok = ok and status == "ok"
+        print(f"{seconds:6.3f}s  {script}  {status}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
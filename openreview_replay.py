@@ -0,0 +1,431 @@
+"""Record/replay layer and local stand-in server for the OpenReview API.
+
+RecordingClient wraps a live openreview.Client and saves every note, reference
+and PDF response it sees into a cache directory. ReplayClient serves those
+responses back from disk, with an optional artificial latency, so that reruns
+and benchmarks of the fetch stage need no network access. Running this module
+serves the same cache over HTTP, so an unmodified openreview.Client can be
+pointed at it with OPENREVIEW_BASEURL=http://localhost:<port>.
+
+Cache layout:
+    notes.jsonl       one note per line, as given by Note.to_json()
+    references.jsonl  one reference per line
+    pdf_status.jsonl  {"id": ..., "status": ..., "error": ...} per PDF request
+    pdfs/<id>.pdf     reference PDF bodies
+"""
+
+import argparse
+import http.server
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import urllib.parse
+
+import openreview
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-c",
+                    "--cache_dir",
+                    type=str,
+                    help="directory with recorded responses",
+                    required=True)
+parser.add_argument("-p", "--port", default=8000, type=int, help="")
+parser.add_argument("-l",
+                    "--latency",
+                    default=0.0,
+                    type=float,
+                    help="artificial latency per request, in seconds")
+
+NOTES_FILE = "notes.jsonl"
+REFERENCES_FILE = "references.jsonl"
+PDF_STATUS_FILE = "pdf_status.jsonl"
+PDF_DIR = "pdfs"
+
+NOT_FOUND_ERROR = {"name": "NotFoundError", "status": 404}
+
+CHUNK_SIZE = 1 << 16
+
+
+def error_from_response(response):
+    """Build the error dict that openreview.Client raises for a response."""
+    if 'application/json' in response.headers.get('Content-Type', ''):
+        error = response.json()
+    else:
+        error = {'name': 'Error', 'message': response.text or response.reason}
+    error.setdefault('status', response.status_code)
+    return error
+
+
+class RecordStore(object):
+    """On-disk cache of OpenReview responses, loaded into memory."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, PDF_DIR), exist_ok=True)
+        self.notes = self._load(NOTES_FILE)
+        self.references = self._load(REFERENCES_FILE)
+        self.pdf_status = self._load(PDF_STATUS_FILE)
+
+    def _load(self, filename):
+        records = {}
+        path = os.path.join(self.cache_dir, filename)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        continue  # Torn last line
+                    records[record["id"]] = record
+        return records
+
+    def _append(self, records, filename, new_records):
+        with self.lock:
+            with open(os.path.join(self.cache_dir, filename), 'a') as f:
+                for record in new_records:
+                    records[record["id"]] = record
+                    f.write(json.dumps(record) + "\n")
+
+    def add_notes(self, notes):
+        self._append(self.notes, NOTES_FILE, [n.to_json() for n in notes])
+
+    def add_references(self, references):
+        self._append(self.references, REFERENCES_FILE,
+                     [r.to_json() for r in references])
+
+    def pdf_path(self, pdf_id):
+        return os.path.join(self.cache_dir, PDF_DIR, f"{pdf_id}.pdf")
+
+    def add_pdf(self, pdf_id, binary):
+        for _ in self.add_pdf_chunks(pdf_id, [binary]):
+            pass
+
+    def add_pdf_chunks(self, pdf_id, chunks):
+        """Save a PDF body while passing its chunks on to the caller."""
+        temp_path = f"{self.pdf_path(pdf_id)}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(temp_path, self.pdf_path(pdf_id))
+        self.add_pdf_status(pdf_id, 200)
+
+    def add_pdf_status(self, pdf_id, status, error=None):
+        self._append(self.pdf_status, PDF_STATUS_FILE, [{
+            "id": pdf_id,
+            "status": status,
+            "error": error
+        }])
+
+    # === Queries =============================================================
+    # These mirror the filters of the API endpoints used by this repo.
+
+    def find_notes(self,
+                   id=None,
+                   forum=None,
+                   invitation=None,
+                   sort=None,
+                   after=None,
+                   mintcdate=None):
+        notes = [
+            n for n in self.notes.values()
+            if (id is None or n["id"] == id) and (
+                forum is None or n["forum"] == forum) and (
+                    invitation is None
+                    or re.fullmatch(invitation, n["invitation"] or "")) and (
+                        mintcdate is None or n["tcdate"] >= mintcdate)
+        ]
+        return sort_and_page(notes, sort, after)
+
+    def find_references(self, referent=None, invitation=None, mintcdate=None):
+        references = [
+            r for r in self.references.values()
+            if (referent is None or r["referent"] == referent) and (
+                invitation is None or r["invitation"] == invitation) and (
+                    mintcdate is None or (r["tcdate"] or 0) >= mintcdate)
+        ]
+        return sorted(references, key=lambda r: r["tcdate"] or 0)
+
+    def find_pdf(self, pdf_id):
+        """Return (status, body or error dict) for a recorded PDF request."""
+        if os.path.isfile(self.pdf_path(pdf_id)):
+            with open(self.pdf_path(pdf_id), 'rb') as f:
+                return 200, f.read()
+        return self.find_pdf_error(pdf_id)
+
+    def find_pdf_error(self, pdf_id):
+        """Like find_pdf, but without reading the body of an available PDF."""
+        if os.path.isfile(self.pdf_path(pdf_id)):
+            return 200, None
+        record = self.pdf_status.get(pdf_id)
+        if record is None or record["status"] == 200:
+            # Never recorded, or only probed
+            return NOT_FOUND_ERROR["status"], NOT_FOUND_ERROR
+        return record["status"], record["error"] or {
+            "name": "Error",
+            "status": record["status"]
+        }
+
+    def probe_pdf(self, pdf_id):
+        record = self.pdf_status.get(pdf_id)
+        if record is not None:
+            return record["status"]
+        return self.find_pdf_error(pdf_id)[0]
+
+
+def sort_and_page(records, sort=None, after=None, offset=None, limit=None):
+    if sort is not None and sort.startswith("id"):
+        records = sorted(records, key=lambda r: r["id"])
+    if after is not None:
+        records = [r for r in records if r["id"] > after]
+    offset = offset or 0
+    if limit is None:
+        return records[offset:]
+    return records[offset:offset + limit]
+
+
+class RecordingClient(object):
+    """Wraps a live client and records every response into a RecordStore."""
+
+    def __init__(self, client, cache_dir):
+        self.client = client
+        self.store = RecordStore(cache_dir)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _record(self, add_function, result):
+        add_function(result[0] if isinstance(result, tuple) else result)
+        return result
+
+    def get_notes(self, **params):
+        return self._record(self.store.add_notes,
+                            self.client.get_notes(**params))
+
+    def get_all_notes(self, **params):
+        return self._record(self.store.add_notes,
+                            self.client.get_all_notes(**params))
+
+    def get_references(self, **params):
+        return self._record(self.store.add_references,
+                            self.client.get_references(**params))
+
+    def get_all_references(self, **params):
+        return self._record(self.store.add_references,
+                            self.client.get_all_references(**params))
+
+    def get_pdf(self, id, is_reference=False):
+        try:
+            binary = self.client.get_pdf(id, is_reference=is_reference)
+        except openreview.OpenReviewException as e:
+            error = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+            self.store.add_pdf_status(id, error.get("status"), error)
+            raise
+        self.store.add_pdf(id, binary)
+        return binary
+
+    def _get_pdf_response(self, id):
+        return self.client.session.get(self.client.pdf_revisions_url,
+                                       params={'id': id},
+                                       headers=self.client.headers,
+                                       stream=True)
+
+    def probe_pdf_status(self, id):
+        with self._get_pdf_response(id) as response:
+            if response.status_code != 429:  # Throttling is not a property
+                self.store.add_pdf_status(id, response.status_code)
+            return response.status_code
+
+    def stream_pdf(self, id, chunk_size=CHUNK_SIZE):
+        with self._get_pdf_response(id) as response:
+            if not response.ok:
+                error = error_from_response(response)
+                if response.status_code != 429:
+                    self.store.add_pdf_status(id, response.status_code, error)
+                raise openreview.OpenReviewException(error)
+            yield from self.store.add_pdf_chunks(
+                id, response.iter_content(chunk_size))
+
+
+class ReplayClient(object):
+    """Serves recorded responses with the interface of openreview.Client."""
+
+    def __init__(self, cache_dir, latency=0.0):
+        self.store = RecordStore(cache_dir)
+        self.latency = latency
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_notes(self,
+                  id=None,
+                  forum=None,
+                  invitation=None,
+                  limit=None,
+                  offset=None,
+                  after=None,
+                  sort=None,
+                  mintcdate=None,
+                  with_count=False,
+                  **unused_params):
+        self._wait()
+        notes = self.store.find_notes(id, forum, invitation, sort, after,
+                                      mintcdate)
+        page = [
+            openreview.Note.from_json(n)
+            for n in sort_and_page(notes, offset=offset, limit=limit)
+        ]
+        if with_count and offset is None:
+            return page, len(notes)
+        return page
+
+    def get_all_notes(self, **params):
+        return self.get_notes(**params)
+
+    def get_references(self,
+                       referent=None,
+                       invitation=None,
+                       limit=None,
+                       offset=None,
+                       mintcdate=None,
+                       with_count=False,
+                       **unused_params):
+        self._wait()
+        references = self.store.find_references(referent, invitation,
+                                                mintcdate)
+        page = [
+            openreview.Note.from_json(r)
+            for r in sort_and_page(references, offset=offset, limit=limit)
+        ]
+        if with_count and offset is None:
+            return page, len(references)
+        return page
+
+    def get_all_references(self, **params):
+        return self.get_references(**params)
+
+    def get_pdf(self, id, is_reference=False):
+        self._wait()
+        status, body = self.store.find_pdf(id)
+        if status != 200:
+            raise openreview.OpenReviewException(body)
+        return body
+
+    def probe_pdf_status(self, id):
+        self._wait()
+        return self.store.probe_pdf(id)
+
+    def stream_pdf(self, id, chunk_size=CHUNK_SIZE):
+        self._wait()
+        status, error = self.store.find_pdf_error(id)
+        if status != 200:
+            raise openreview.OpenReviewException(error)
+        with open(self.store.pdf_path(id), 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+
+# == Local stand-in server ===================================================
+
+
+def make_handler(store, latency):
+
+    def parse_query(path):
+        params = {
+            key: values[0]
+            for key, values in urllib.parse.parse_qs(
+                urllib.parse.urlparse(path).query).items()
+        }
+        for key in ["limit", "offset", "mintcdate"]:
+            if key in params:
+                params[key] = int(params[key])
+        return params
+
+    class StandInHandler(http.server.BaseHTTPRequestHandler):
+
+        def _send(self, status, body, content_type="application/json"):
+            if content_type == "application/json":
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_file(self, path):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            endpoint = urllib.parse.urlparse(self.path).path.rstrip("/")
+            params = parse_query(self.path)
+            if endpoint == "/notes":
+                notes = store.find_notes(params.get("id"), params.get("forum"),
+                                         params.get("invitation"),
+                                         params.get("sort"),
+                                         params.get("after"),
+                                         params.get("mintcdate"))
+                self._send(
+                    200, {
+                        "notes":
+                        sort_and_page(notes,
+                                      offset=params.get("offset"),
+                                      limit=params.get("limit")),
+                        "count":
+                        len(notes)
+                    })
+            elif endpoint == "/references":
+                references = store.find_references(params.get("referent"),
+                                                   params.get("invitation"),
+                                                   params.get("mintcdate"))
+                self._send(
+                    200, {
+                        "references":
+                        sort_and_page(references,
+                                      offset=params.get("offset"),
+                                      limit=params.get("limit")),
+                        "count":
+                        len(references)
+                    })
+            elif endpoint == "/references/pdf":
+                status, error = store.find_pdf_error(params.get("id"))
+                if status == 200:
+                    self._send_file(store.pdf_path(params.get("id")))
+                else:
+                    self._send(status, error)
+            else:
+                self._send(404, NOT_FOUND_ERROR)
+
+        def log_message(self, format, *args):
+            pass  # Keep benchmark output readable
+
+    return StandInHandler
+
+
+def serve(cache_dir, port, latency=0.0):
+    server = http.server.ThreadingHTTPServer(
+        ("localhost", port), make_handler(RecordStore(cache_dir), latency))
+    server.serve_forever()
+
+
+def main():
+    args = parser.parse_args()
+    serve(args.cache_dir, args.port, args.latency)
+
+
+if __name__ == "__main__":
+    main()
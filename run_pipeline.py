@@ -0,0 +1,338 @@
+"""Incremental runner for the 00_extract and 01_analyze stages.
+
+Stages, and the files they read and write in each forum directory:
+
+  extract          initial.pdf, final.pdf -> initial.txt, final.txt
+  diffs            initial.txt, final.txt -> diffs.json
+  section_offsets  diffs.json -> section_offsets.json
+  reduced_diffs    diffs.json, section_offsets.json of all forums
+                   -> <conference>/reduced_diffs/*.jsonl
+
+(extract replaces the old pdf -> raw -> clean steps, see 01_extract_text.py.)
+
+A stage is rerun only if one of its outputs is missing, or if the content of
+one of its inputs, the code of the stage or the settings it runs with (e.g.
+--tokenizer and --matcher for diffs) changed since it last ran. A forum whose
+diff is empty has no section offsets; that is recorded as done. Input
+hashes are remembered along with file size and mtime, so unchanged files are
+not read again. If a rebuilt file comes out identical, later stages are
+skipped. Forums are processed in parallel, and the stamps are kept in
+<data_dir>/<conference>/pipeline_state.json.
+"""
+
+import argparse
+import collections
+import functools
+import glob
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import tqdm
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(REPO_DIR, "00_extract"))  # for pdfdiff
+
+import scc_diff_lib
+import scc_lib
+import scc_tokenize_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-d", "--data_dir", default="", type=str, help="")
+parser.add_argument("-c",
+                    "--conference",
+                    type=str,
+                    choices=scc_lib.Conference.ALL,
+                    help="conference_year, e.g. iclr_2022",
+                    required=True)
+parser.add_argument("-j",
+                    "--jobs",
+                    default=1,
+                    type=int,
+                    help="number of forums to process in parallel")
+parser.add_argument("-t",
+                    "--timeout",
+                    default=300,
+                    type=int,
+                    help="seconds allowed for extracting a single PDF")
+parser.add_argument("--tokenizer",
+                    default=scc_tokenize_lib.STANZA,
+                    choices=scc_tokenize_lib.TOKENIZERS,
+                    help="tokenizer for the diffs stage")
+parser.add_argument("-m",
+                    "--matcher",
+                    default=scc_diff_lib.DIFFLIB,
+                    choices=scc_diff_lib.MATCHERS,
+                    help="matcher for the diffs stage")
+parser.add_argument("-n",
+                    "--dry_run",
+                    action="store_true",
+                    help="only report which stages are out of date")
+
+PIPELINE_STATE = "pipeline_state.json"
+SAVE_EVERY = 100  # forums
+
+Stage = collections.namedtuple("Stage", "name inputs outputs sources")
+
+FORUM_STAGES = [
+    Stage("extract", ["initial.pdf", "final.pdf"],
+          ["initial.txt", "final.txt"], [
+              "00_extract/01_extract_text.py", "00_extract/pdfdiff.py",
+              "scc_lib.py"
+          ]),
+    Stage("diffs", ["initial.txt", "final.txt"], ["diffs.json"], [
+        "00_extract/03_extract_diffs.py", "scc_lib.py", "scc_diff_lib.py",
+        "scc_tokenize_lib.py"
+    ]),
+    Stage("section_offsets", ["diffs.json"], ["section_offsets.json"],
+          ["00_extract/04_sectionize.py"]),
+]
+REDUCED_DIFFS = Stage("reduced_diffs", ["diffs.json", "section_offsets.json"],
+                      ["reduced_diffs"], ["01_analyze/02_typify_diffs.py"])
+
+
+class Action(object):
+    BUILT = "built"
+    SKIPPED = "skipped"
+    OUT_OF_DATE = "out_of_date"  # Not built because of --dry_run
+    MISSING_INPUTS = "missing_inputs"
+    FAILED = "failed"
+    ALL = [BUILT, SKIPPED, OUT_OF_DATE, MISSING_INPUTS, FAILED]
+
+
+@functools.lru_cache(maxsize=None)
+def load_stage_module(source):
+    """Import a stage script (their names start with digits)."""
+    name = os.path.splitext(os.path.basename(source))[0]
+    spec = importlib.util.spec_from_file_location(
+        f"stage_{name}", os.path.join(REPO_DIR, source))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def code_version(stage, settings=()):
+    """Hash of the stage's sources and of the settings it is run with."""
+    h = hashlib.sha256()
+    for source in stage.sources:
+        with open(os.path.join(REPO_DIR, source), 'rb') as f:
+            h.update(f.read())
+    for setting in settings:
+        h.update(f'\n{setting}'.encode())
+    return h.hexdigest()
+
+
+def stage_settings(args):
+    """Settings that change what a stage writes, by stage name."""
+    return {
+        "diffs": [
+            scc_tokenize_lib.tokenizer_version(args.tokenizer),
+            f"matcher {args.matcher}"
+        ],
+    }
+
+
+def file_digest(path, hashes, key):
+    """SHA-256 of a file, reusing the hash in `hashes` if size and mtime match.
+    """
+    stat = os.stat(path)
+    known = hashes.get(key)
+    if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known[2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    hashes[key] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+
+def run_extract(forum_dir, options):
+    extract_text = load_stage_module("00_extract/01_extract_text.py")
+    for version in [scc_lib.INITIAL, scc_lib.FINAL]:
+        _, error = extract_text.extract_pdf(f'{forum_dir}/{version}.pdf',
+                                            options["timeout"])
+        if error is not None:
+            raise ValueError(error)
+
+
+def run_diffs(forum_dir, options):
+    load_stage_module("00_extract/03_extract_diffs.py").extract_diffs(
+        f'{forum_dir}/initial.txt',
+        options["tokenizer"],
+        matcher=options["matcher"])
+
+
+def run_section_offsets(forum_dir, options):
+    diffs_path = f'{forum_dir}/diffs.json'
+    if os.path.getsize(diffs_path) == 0:
+        # No valid diff, so there is nothing to sectionize. Remove offsets
+        # left over from an earlier diff.
+        try:
+            os.remove(f'{forum_dir}/section_offsets.json')
+        except FileNotFoundError:
+            pass
+        return NO_OUTPUT
+    load_stage_module("00_extract/04_sectionize.py").calculate_section_offsets(
+        diffs_path)
+
+
+# Returned by a stage function that correctly wrote no output
+NO_OUTPUT = "no_output"
+
+STAGE_FUNCTIONS = {
+    "extract": run_extract,
+    "diffs": run_diffs,
+    "section_offsets": run_section_offsets,
+}
+
+
+def process_forum(item):
+    """Bring one forum up to date, returning (forum, state, actions).
+
+    `actions` has one (stage name, Action, message) triple per stage. Runs in a
+    worker process.
+    """
+    forum_dir, state, code_versions, options = item
+    hashes = state.setdefault("hashes", {})
+    stamps = state.setdefault("stamps", {})
+    actions = []
+    for stage in FORUM_STAGES:
+        input_paths = [os.path.join(forum_dir, x) for x in stage.inputs]
+        output_paths = [os.path.join(forum_dir, x) for x in stage.outputs]
+        if not all(os.path.isfile(x) for x in input_paths):
+            # Later stages may still run on outputs from an earlier run
+            actions.append((stage.name, Action.MISSING_INPUTS, None))
+            continue
+
+        stamp = {
+            "code": code_versions[stage.name],
+            "inputs": {
+                x: file_digest(path, hashes, x)
+                for x, path in zip(stage.inputs, input_paths)
+            }
+        }
+        recorded = dict(stamps.get(stage.name, {}))
+        no_output = recorded.pop(NO_OUTPUT, False)
+        if recorded == stamp and (no_output or all(
+                os.path.isfile(x) for x in output_paths)):
+            actions.append((stage.name, Action.SKIPPED, None))
+            continue
+        if options["dry_run"]:
+            actions.append((stage.name, Action.OUT_OF_DATE, None))
+            continue
+
+        stamps.pop(stage.name, None)
+        try:
+            result = STAGE_FUNCTIONS[stage.name](forum_dir, options)
+        except Exception as e:
+            actions.append(
+                (stage.name, Action.FAILED, f"{type(e).__name__}: {e}"))
+            continue
+        if result == NO_OUTPUT:
+            stamp[NO_OUTPUT] = True
+        elif not all(os.path.isfile(x) for x in output_paths):
+            actions.append((stage.name, Action.FAILED, "no output written"))
+            continue
+        stamps[stage.name] = stamp
+        actions.append((stage.name, Action.BUILT, None))
+
+    return os.path.basename(forum_dir), state, actions
+
+
+def reduced_diffs_stamp(conference_dir, forum_states, code):
+    """Stamp over the diffs and section offsets of every forum."""
+    h = hashlib.sha256(code.encode())
+    for forum in sorted(forum_states):
+        hashes = forum_states[forum].setdefault("hashes", {})
+        for x in REDUCED_DIFFS.inputs:
+            path = os.path.join(conference_dir, forum, x)
+            if os.path.isfile(path):
+                digest = file_digest(path, hashes, x)
+                h.update(f'{forum}/{x}:{digest}\n'.encode())
+    return h.hexdigest()
+
+
+def save_state(path, state):
+    scc_lib.write_file_atomically(path, json.dumps(state))
+
+
+def main():
+    args = parser.parse_args()
+    conference_dir = f"{args.data_dir}/{args.conference}"
+    state_path = os.path.join(conference_dir, PIPELINE_STATE)
+    state = {"forums": {}, "conference": {}}
+    if os.path.isfile(state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+
+    settings = stage_settings(args)
+    code_versions = {
+        stage.name: code_version(stage, settings.get(stage.name, ()))
+        for stage in FORUM_STAGES + [REDUCED_DIFFS]
+    }
+    options = {
+        "data_dir": args.data_dir,
+        "timeout": args.timeout,
+        "tokenizer": args.tokenizer,
+        "matcher": args.matcher,
+        "dry_run": args.dry_run,
+    }
+    forum_dirs = sorted({
+        os.path.dirname(x)
+        for x in glob.glob(f"{conference_dir}/*/initial.pdf") +
+        glob.glob(f"{conference_dir}/*/initial.txt")
+    })
+    items = [(forum_dir, state["forums"].get(os.path.basename(forum_dir),
+                                             {}), code_versions, options)
+             for forum_dir in forum_dirs]
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap_unordered(process_forum, items)
+    else:
+        pool = None
+        results = map(process_forum, items)
+
+    counts = collections.defaultdict(collections.Counter)
+    failures = []
+    for i, (forum, forum_state,
+            actions) in enumerate(tqdm.tqdm(results, total=len(items))):
+        state["forums"][forum] = forum_state
+        for stage_name, action, message in actions:
+            counts[stage_name][action] += 1
+            if action == Action.FAILED:
+                failures.append((forum, stage_name, message))
+        if not args.dry_run and i % SAVE_EVERY == SAVE_EVERY - 1:
+            save_state(state_path, state)
+    if pool is not None:
+        pool.close()
+
+    stamp = reduced_diffs_stamp(conference_dir, state["forums"],
+                                code_versions[REDUCED_DIFFS.name])
+    if (state["conference"].get(REDUCED_DIFFS.name) == stamp and os.path.isdir(
+            os.path.join(conference_dir, REDUCED_DIFFS.outputs[0]))):
+        counts[REDUCED_DIFFS.name][Action.SKIPPED] += 1
+    elif args.dry_run:
+        counts[REDUCED_DIFFS.name][Action.OUT_OF_DATE] += 1
+    else:
+        load_stage_module("01_analyze/02_typify_diffs.py").write_reduced_diffs(
+            args.data_dir, args.conference)
+        state["conference"][REDUCED_DIFFS.name] = stamp
+        counts[REDUCED_DIFFS.name][Action.BUILT] += 1
+
+    if not args.dry_run:
+        save_state(state_path, state)
+
+    for forum, stage_name, message in failures:
+        print(f"{forum}\t{stage_name}\t{message}")
+    for stage in FORUM_STAGES + [REDUCED_DIFFS]:
+        print(stage.name + ": " + ", ".join(
+            f"{counts[stage.name][action]} {action}"
+            for action in Action.ALL if counts[stage.name][action]))
+
+
+if __name__ == "__main__":
+    main()
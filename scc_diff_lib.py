@@ -5,14 +5,21 @@ quite high, O(nd) runtime of Myers is prohibitively high. Also, since diffs can
 be very localized, there are large unchanged subsequences.
 
 We first use get_matching_blocks from difflib (Python library) to find maximal
-unchanged subsequences. We invert this list to find non-matching blocks, then
-use Myers to describe the edirs within the non-matching blocks.
+unchanged subsequences, or anchor on rare tokens with matcher=PATIENCE or
+matcher=HISTOGRAM (see anchored_matching_blocks). We invert this list to find
+non-matching blocks, then use Myers to describe the edirs within the
+non-matching blocks.
+
+Both steps compare integer token ids rather than strings. Tokens are mapped to
+ids by a TokenVocabulary, and only mapped back when Diffs are built.
 """
 
+import array
+import bisect
 import collections
 import difflib
+import itertools
 import json
-import myers
 import re
 import sys
 import tqdm
@@ -21,6 +28,13 @@ MATCHING_BLOCK = "MatchingBlock"
 NONMATCHING_BLOCK = "NonMatchingBlock"
 MAX_LEN = 3000
 
+# Engines for finding matching blocks
+DIFFLIB = "difflib"
+PATIENCE = "patience"
+HISTOGRAM = "histogram"
+MATCHERS = [DIFFLIB, PATIENCE, HISTOGRAM]
+MAX_CHAIN = 64  # Tokens more frequent than this in a range are not anchors
+
 MatchingBlock = collections.namedtuple(MATCHING_BLOCK, "a b l".split())
 NonMatchingBlock = collections.namedtuple(NONMATCHING_BLOCK,
                                           "a b l_a l_b".split())
@@ -31,16 +45,281 @@ def flatten_sentences(sentences):
     return sum(sentences, [])
 
 
+KEEP, INSERT, REMOVE = 'kir'
+
+
+def myers_edits(a, b):
+    """Myers diff of two sequences, as a list of (action, element) pairs.
+
+    Gives the same edit script as myers.diff from the myers package (1.0.1),
+    which copies the whole path so far for every diagonal at every step. Here
+    only the furthest x on each diagonal is kept for each step, and the path
+    is recovered by walking back through the steps at the end.
+    """
+    n, m = len(a), len(b)
+    fronts = []  # fronts[d][(k + d) // 2] is the furthest x on diagonal k
+    for d in range(n + m + 1):
+        front = array.array('l')
+        for k in range(-d, d + 1, 2):
+            x = myers_step_start(fronts, d, k)[0]
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            if x >= n and y >= m:
+                fronts.append(front)
+                return myers_path(a, b, fronts, d, k, x)
+            front.append(x)
+        fronts.append(front)
+
+    raise ValueError('Unable to compute diff')
+
+
+def myers_step_start(fronts, d, k):
+    """Where step d of diagonal k starts, and whether it moves down."""
+    if not d:
+        return 0, True
+    prev = fronts[d - 1]
+    i = (k + d) // 2  # diagonal k + 1 in prev; k - 1 is just before it
+    go_down = k == -d or (k != d and prev[i - 1] < prev[i])
+    if go_down:
+        return prev[i], True
+    return prev[i - 1] + 1, False
+
+
+def myers_path(a, b, fronts, d, k, x):
+    """Walk back from x on diagonal k at step d, building the edit script."""
+    path = []
+    while True:
+        x_start, go_down = myers_step_start(fronts, d, k)
+        for i in range(x - 1, x_start - 1, -1):
+            path.append((KEEP, a[i]))
+        y_start = x_start - k
+        # Same tests as myers.diff, including at the edges of the grid
+        if 1 <= y_start <= len(b) and go_down:
+            path.append((INSERT, b[y_start - 1]))
+        elif 1 <= x_start <= len(a):
+            path.append((REMOVE, a[x_start - 1]))
+        if not d:
+            break
+        x = x_start if go_down else x_start - 1
+        k = k + 1 if go_down else k - 1
+        d -= 1
+    path.reverse()
+    return path
+
+
+def histogram_anchor(a, b, alo, ahi, blo, bhi, max_chain=MAX_CHAIN):
+    """Best anchor for a[alo:ahi] and b[blo:bhi], as (i, j, size) or None.
+
+    The anchor is a maximal common run whose least frequent token (counted in
+    a[alo:ahi]) is as rare as possible, preferring longer runs on ties. This
+    is the choice made by git's histogram diff.
+    """
+    positions = collections.defaultdict(list)
+    for i in range(alo, ahi):
+        positions[a[i]].append(i)
+
+    best = None
+    best_count = max_chain + 1
+    j = blo
+    while j < bhi:
+        next_j = j + 1
+        occurrences = positions.get(b[j], ())
+        if len(occurrences) <= min(best_count, max_chain):
+            for i in occurrences:
+                count = len(occurrences)
+                start_i, start_j = i, j
+                while (start_i > alo and start_j > blo
+                       and a[start_i - 1] == b[start_j - 1]):
+                    start_i -= 1
+                    start_j -= 1
+                    count = min(count, len(positions[a[start_i]]))
+                end_i, end_j = i + 1, j + 1
+                while end_i < ahi and end_j < bhi and a[end_i] == b[end_j]:
+                    count = min(count, len(positions[a[end_i]]))
+                    end_i += 1
+                    end_j += 1
+                # Later seeds inside this run would find the same run
+                next_j = max(next_j, end_j)
+                size = end_i - start_i
+                if count < best_count or (count == best_count
+                                          and size > best[2]):
+                    best = (start_i, start_j, size)
+                    best_count = count
+        j = next_j
+    return best
+
+
+def patience_anchors(a, b, alo, ahi, blo, bhi):
+    """Anchors for a[alo:ahi] and b[blo:bhi], as a list of (i, j, 1).
+
+    Tokens that occur exactly once in each range are candidates, and the
+    longest subsequence of them that is in the same order in both is kept
+    (patience diff).
+    """
+    counts = collections.Counter(a[alo:ahi])
+    b_positions = {}
+    for j in range(blo, bhi):
+        if counts[b[j]] == 1:
+            # None marks tokens seen more than once in b
+            b_positions[b[j]] = None if b[j] in b_positions else j
+    candidates = [(i, b_positions[a[i]]) for i in range(alo, ahi)
+                  if b_positions.get(a[i]) is not None]
+
+    # Patience sorting: tails[k] is the candidate ending the best increasing
+    # run of length k + 1 found so far
+    tails = []
+    tail_js = []
+    previous = {}
+    for i, j in candidates:
+        k = bisect.bisect_left(tail_js, j)
+        previous[i] = tails[k - 1] if k else None
+        if k == len(tails):
+            tails.append((i, j))
+            tail_js.append(j)
+        else:
+            tails[k] = (i, j)
+            tail_js[k] = j
+    anchors = []
+    anchor = tails[-1] if tails else None
+    while anchor is not None:
+        anchors.append((anchor[0], anchor[1], 1))
+        anchor = previous[anchor[0]]
+    anchors.reverse()
+    return anchors
+
+
+def anchored_matching_blocks(a, b, matcher=PATIENCE, max_chain=MAX_CHAIN):
+    """Matching blocks in the format of SequenceMatcher.get_matching_blocks.
+
+    Finds anchors in the whole range and recurses on the ranges between them.
+    With PATIENCE, anchors are unique tokens (see patience_anchors), and a
+    range without any falls back to one histogram anchor. With HISTOGRAM,
+    each range gets one anchor on its rarest tokens (see histogram_anchor).
+    Unlike SequenceMatcher, no token is junked for being frequent overall:
+    frequency is counted within each range, so "the" can anchor a short one.
+    Ranges with no anchor at all (e.g. only common tokens, reordered) are
+    matched by SequenceMatcher, without its autojunk heuristic.
+    """
+    found = []
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        alo, ahi, blo, bhi = ranges.pop()
+        # Common prefixes and suffixes are matched without a search
+        prefix = 0
+        while (alo + prefix < ahi and blo + prefix < bhi
+               and a[alo + prefix] == b[blo + prefix]):
+            prefix += 1
+        if prefix:
+            found.append((alo, blo, prefix))
+            alo += prefix
+            blo += prefix
+        suffix = 0
+        while (ahi - suffix > alo and bhi - suffix > blo
+               and a[ahi - suffix - 1] == b[bhi - suffix - 1]):
+            suffix += 1
+        if suffix:
+            found.append((ahi - suffix, bhi - suffix, suffix))
+            ahi -= suffix
+            bhi -= suffix
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = []
+        if matcher == PATIENCE:
+            anchors = patience_anchors(a, b, alo, ahi, blo, bhi)
+        if not anchors:
+            anchor = histogram_anchor(a, b, alo, ahi, blo, bhi, max_chain)
+            if anchor is None:
+                fallback = difflib.SequenceMatcher(None,
+                                                   a[alo:ahi],
+                                                   b[blo:bhi],
+                                                   autojunk=False)
+                found += [(alo + i, blo + j, size)
+                          for i, j, size in fallback.get_matching_blocks()
+                          if size]
+                continue
+            anchors = [anchor]
+        found += anchors
+        for i, j, size in anchors:
+            ranges.append((alo, i, blo, j))
+            alo, blo = i + size, j + size
+        ranges.append((alo, ahi, blo, bhi))
+
+    # Merge adjacent blocks, as get_matching_blocks does
+    matching_blocks = []
+    for i, j, size in sorted(found):
+        if matching_blocks:
+            prev_i, prev_j, prev_size = matching_blocks[-1]
+            if prev_i + prev_size == i and prev_j + prev_size == j:
+                matching_blocks[-1] = difflib.Match(prev_i, prev_j,
+                                                    prev_size + size)
+                continue
+        matching_blocks.append(difflib.Match(i, j, size))
+    matching_blocks.append(difflib.Match(len(a), len(b), 0))
+    return matching_blocks
+
+
+def get_matching_blocks(a, b, matcher=DIFFLIB):
+    if matcher in [PATIENCE, HISTOGRAM]:
+        return anchored_matching_blocks(a, b, matcher)
+    assert matcher == DIFFLIB
+    return difflib.SequenceMatcher(None, a, b).get_matching_blocks()
+
+
+class TokenVocabulary(object):
+    """Maps token strings to integer ids, in order of first appearance.
+
+    Ids are stored as arrays of unsigned ints (4 bytes per token). A vocabulary
+    can be shared by several DocumentDiffs.
+    """
+
+    TYPECODE = 'I'
+
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def encode(self, tokens):
+        ids = self.ids
+        encoded = array.array(self.TYPECODE)
+        for token in tokens:
+            i = ids.get(token)
+            if i is None:
+                i = ids[token] = len(self.tokens)
+                self.tokens.append(token)
+            encoded.append(i)
+        return encoded
+
+    def decode(self, ids):
+        tokens = self.tokens
+        return [tokens[i] for i in ids]
+
+
 class DocumentDiff(object):
 
-    def __init__(self, unflat_source_tokens, unflat_dest_tokens, forum):
+    def __init__(self,
+                 unflat_source_tokens,
+                 unflat_dest_tokens,
+                 forum,
+                 vocabulary=None,
+                 matcher=DIFFLIB):
         # Saving these, but they are only used for output
         self.source_unflat = unflat_source_tokens
         self.dest_unflat = unflat_dest_tokens
         self.forum = forum
-        # Flattened tokens are used in the diff calculations
-        self.source_tokens = flatten_sentences(unflat_source_tokens)
-        self.dest_tokens = flatten_sentences(unflat_dest_tokens)
+        self.matcher = matcher
+        # Flattened token ids are used in the diff calculations
+        self.vocabulary = (TokenVocabulary()
+                           if vocabulary is None else vocabulary)
+        self.source_ids = self.vocabulary.encode(
+            itertools.chain.from_iterable(unflat_source_tokens))
+        self.dest_ids = self.vocabulary.encode(
+            itertools.chain.from_iterable(unflat_dest_tokens))
 
         #with open('debug_source_tokens.txt', 'w') as f:
         #    f.write("\n".join(self.source_tokens))
@@ -49,6 +328,14 @@ class DocumentDiff(object):
 
         self.calculate()
 
+    @property
+    def source_tokens(self):
+        return self.vocabulary.decode(self.source_ids)
+
+    @property
+    def dest_tokens(self):
+        return self.vocabulary.decode(self.dest_ids)
+
     def calculate(self):
         #print("calculating")
         self.diffs = []
@@ -71,8 +358,8 @@ class DocumentDiff(object):
         """Get maximal matching blocks and calculate nonmatching blocks.
         """
         #print("start matching blocks")
-        matching_blocks = difflib.SequenceMatcher(
-            None, self.source_tokens, self.dest_tokens).get_matching_blocks()
+        matching_blocks = get_matching_blocks(self.source_ids, self.dest_ids,
+                                              self.matcher)
         #print("done matching blocks")
 
         blocks = []  # Alternating matching and nonmatching blocks
@@ -115,13 +402,16 @@ class DocumentDiff(object):
             # an appendix being added. We just convert the block into one large
             # diff.
             return [
-                Diff(block.a, self.source_tokens[block.a:block.a + block.l_a],
-                     self.dest_tokens[block.b:block.b + block.l_b])
+                Diff(
+                    block.a,
+                    self.vocabulary.decode(self.source_ids[block.a:block.a +
+                                                           block.l_a]),
+                    self.vocabulary.decode(self.dest_ids[block.b:block.b +
+                                                         block.l_b]))
             ]
 
-        myers_diff = myers.diff(
-            self.source_tokens[block.a:block.a + block.l_a],
-            self.dest_tokens[block.b:block.b + block.l_b])
+        myers_diff = myers_edits(self.source_ids[block.a:block.a + block.l_a],
+                                 self.dest_ids[block.b:block.b + block.l_b])
 
         # In our method of diff naming, each diff needs to be anchored to an
         # index in the source sequence. The anchors are collected below.
@@ -145,18 +435,21 @@ class DocumentDiff(object):
             removed = []
 
             for i in range(start, end):
-                action, token = myers_diff[i]
+                action, token_id = myers_diff[i]
                 if action == 'i':
-                    inserted.append(token)
+                    inserted.append(token_id)
                 else:
-                    removed.append(token)
+                    removed.append(token_id)
+            inserted = self.vocabulary.decode(inserted)
+            removed = self.vocabulary.decode(removed)
 
             if 'r' not in diff_substr:
                 # This diff has only removes, so it has nothing to anchor to in
                 # the source sequence. We artificially remove and reinsert the
                 # token just before the diff.
                 diff_anchor -= 1
-                anchor_token = self.source_tokens[diff_anchor]
+                anchor_token = self.vocabulary.tokens[
+                    self.source_ids[diff_anchor]]
                 diffs.append(
                     Diff(diff_anchor, [anchor_token] + removed,
                          [anchor_token] + inserted))
@@ -182,31 +475,30 @@ class DocumentDiff(object):
     # These methods are used to check for bugs in the diff logic.
 
     def _reconstruct_from_blocks(self):
-        reconstructed_tokens = []
+        reconstructed_ids = array.array(TokenVocabulary.TYPECODE)
         for block in self.blocks:
             if isinstance(block, MatchingBlock):
-                reconstructed_tokens += self.source_tokens[block.a:block.a +
-                                                           block.l]
+                reconstructed_ids += self.source_ids[block.a:block.a + block.l]
             else:
                 assert isinstance(block, NonMatchingBlock)
                 if block.l_b:
-                    reconstructed_tokens += self.dest_tokens[block.b:block.b +
-                                                             block.l_b]
+                    reconstructed_ids += self.dest_ids[block.b:block.b +
+                                                       block.l_b]
 
-        assert reconstructed_tokens == self.dest_tokens
+        assert reconstructed_ids == self.dest_ids
 
     def _reconstruct_from_diffs(self):
-        reconstructed_tokens = []
+        reconstructed_ids = array.array(TokenVocabulary.TYPECODE)
         source_cursor = 0
         for i, diff in enumerate(self.diffs):
-            reconstructed_tokens += self.source_tokens[source_cursor:diff.
-                                                       index]
-            reconstructed_tokens += diff.new
+            reconstructed_ids += self.source_ids[source_cursor:diff.index]
+            # Diff tokens all come from the two documents, so this adds no ids
+            reconstructed_ids += self.vocabulary.encode(diff.new)
             source_cursor = diff.index + len(diff.old)
 
-        reconstructed_tokens += self.source_tokens[source_cursor:]
+        reconstructed_ids += self.source_ids[source_cursor:]
 
-        if not reconstructed_tokens == self.dest_tokens:
+        if not reconstructed_ids == self.dest_ids:
             print(f"Error reconstructing: {self.forum}")
             self.is_valid = False
         else:
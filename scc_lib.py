@@ -1,6 +1,24 @@
-import stanza
+import json
+import os
+import re
 
-SENTENCIZE_PIPELINE = stanza.Pipeline("en", processors="tokenize")
+
+def __getattr__(name):
+    # SENTENCIZE_PIPELINE used to be built at import time. Tokenizers are now
+    # in scc_tokenize_lib.
+    if name == "SENTENCIZE_PIPELINE":
+        import scc_tokenize_lib
+        return scc_tokenize_lib.get_sentencize_pipeline()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def write_file_atomically(path, text):
+    """Write to a temporary file first so readers never see a partial file.
+    """
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
 
 
 class Conference(object):
@@ -32,4 +50,98 @@ class ForumStatus(object):
     NO_DECISION = "no_decision"
 
 
+# == Content-addressed PDF storage ===========================================
+# Each PDF is written once under <data_dir>/blobs/, keyed by its SHA-256. Forum
+# directories hold links to the blobs, plus a manifest mapping each version to
+# its digest, so identical initial and final PDFs can be recognized without
+# reading them.
+
+PDF_BLOB_DIR = "blobs"
+PDF_MANIFEST = "pdfs.json"
+
+# Files computed from a forum's PDFs by later stages
+DERIVED_FILES = [
+    "initial_raw.txt",
+    "final_raw.txt",
+    "initial.txt",
+    "final.txt",
+    "initial_pages.json",
+    "final_pages.json",
+    "diffs.json",
+    "section_offsets.json",
+]
+
+
+def pdf_blob_dir(conference_dir):
+    """Blobs are shared by all conferences under the same data dir."""
+    return os.path.join(os.path.dirname(os.path.normpath(conference_dir)),
+                        PDF_BLOB_DIR)
+
+
+def pdf_blob_path(blob_dir, digest):
+    return os.path.join(blob_dir, digest[:2], f'{digest}.pdf')
+
+
+def read_pdf_manifest(forum_dir):
+    """Map each version to its PDF digest, or None for unmanaged forums."""
+    try:
+        with open(os.path.join(forum_dir, PDF_MANIFEST), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def same_pdf_blob(forum_dir):
+    manifest = read_pdf_manifest(forum_dir)
+    return manifest is not None and manifest[INITIAL] == manifest[FINAL]
+
+
+# == ICLR boilerplate ========================================================
+# Recurring lines in ICLR PDFs that only add noise to diffs.
+
+UNDER_REVIEW_RE = re.compile(
+    "Under review as a conference paper at ICLR 20[0-9]{2}")
+#Under review as a conference paper at ICLR 2022
+PUBLISHED_RE = re.compile("Published as a conference paper at ICLR 20[0-9]{2}")
+
+ABSTRACT = "ABSTRACT"
+REFERENCES = "REFERENCES"
+
+#TODO: find out what ABSTRACT_HEADER and SECTION_HEADER as supposed to do
+
+
+def clean_lines(lines):
+    """Strip boilerplate from extracted text lines, stopping at references.
+
+    Lines are consumed one at a time. The boilerplate line is identified by
+    the first line that matches either pattern; no earlier line can match it.
+    """
+    boilerplate_re = None  # Sometimes this doesn't match anywhere?
 
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        # Figure out what the boilerplate line is. For rejected papers, the
+        # final pdf may still be 'Under review'.
+        if boilerplate_re is None:
+            if UNDER_REVIEW_RE.match(line):
+                boilerplate_re = UNDER_REVIEW_RE
+            elif PUBLISHED_RE.match(line):
+                boilerplate_re = PUBLISHED_RE
+        if line.startswith("R EFERENCES") or line.startswith(REFERENCES):
+            # Typo fixed in 2022
+            # References starting. We are done.
+            return
+        if boilerplate_re is not None and boilerplate_re.match(line):
+            yield from re.split(boilerplate_re, line)
+        elif ABSTRACT in line and not line.startswith(ABSTRACT):
+            try:
+                before, after = re.split(ABSTRACT, line)
+            except ValueError:
+                yield line
+            else:
+                yield before
+                yield ABSTRACT + after
+        else:
+            yield line
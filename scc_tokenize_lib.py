@@ -0,0 +1,416 @@
+"""Tokenizers for diffs and reviews, and the on-disk token cache.
+
+Kept apart from scc_lib so that stages which do not tokenize, and the stamps
+run_pipeline.py keeps for them, do not depend on this code.
+"""
+
+import array
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import importlib.metadata
+import multiprocessing
+import os
+import re
+import tempfile
+import zlib
+
+# stanza (and torch with it) is only imported by the stages that tokenize, the
+# first time they do. Importing it here would slow down every script.
+
+
+@functools.lru_cache(maxsize=None)
+def get_sentencize_pipeline():
+    import stanza
+    return stanza.Pipeline("en", processors="tokenize")
+
+
+def make_documents(texts):
+    import stanza
+    return [stanza.Document([], text=text) for text in texts]
+
+
+# Tokenizer backends. stanza is the reference; regex is a rule-based
+# approximation that is much faster, for bulk reprocessing where stable tokens
+# matter more than exact sentence boundaries. benchmark_tokenizers.py measures
+# how closely they agree.
+STANZA, REGEX = "stanza regex".split()
+TOKENIZERS = [STANZA, REGEX]
+
+
+def sentencize_batch(texts, tokenizer=STANZA):
+    """Split many texts into sentences with a single stanza call."""
+    if tokenizer == REGEX:
+        return [regex_sentencize(text) for text in texts]
+    documents = get_sentencize_pipeline()(make_documents(texts))
+    return [[sent.text for sent in document.sentences]
+            for document in documents]
+
+
+def tokenize_batch(texts, tokenizer=STANZA):
+    """Tokenize many texts with a single stanza call.
+
+    Returns one list of sentences per text, each sentence a list of token
+    strings.
+    """
+    if tokenizer == REGEX:
+        return [regex_tokenize(text) for text in texts]
+    documents = get_sentencize_pipeline()(make_documents(texts))
+    return [[[token.text for token in sentence.tokens]
+             for sentence in document.sentences] for document in documents]
+
+
+# == Rule-based tokenizer ====================================================
+# Roughly follows the stanza English tokenizer: punctuation is split off
+# words, except in numbers and abbreviations, and "n't" and clitics such as
+# "'s" are separate tokens. A sentence ends at ., ! or ? (possibly followed by
+# closing quotes or brackets) when the next token starts with an uppercase
+# letter, a digit or an opening bracket, and at blank lines.
+
+REGEX_TOKENIZER_VERSION = 3  # Bump when the rules change
+
+ABBREVIATIONS = [
+    "al", "approx", "cf", "Dr", "Eq", "Eqn", "Eqs", "etc", "Fig", "Figs", "Mr",
+    "Mrs", "Ms", "No", "pp", "Prof", "Ref", "Refs", "resp", "Sec", "Secs",
+    "Tab", "Thm", "vs", "Vol"
+]
+TOKEN_RE = re.compile(
+    r"""
+    (?:[A-Za-z]\.){2,}                  # e.g. i.e. U.S.
+    | (?-i:%s)\.(?=\s|$)                # Fig. Eq. et al., case-sensitive
+    | \d+(?:[.,:/]\d+)*                 # 3.5 1,000 10/2
+    | \w+(?=n't\b)                      # do|n't
+    | n't\b
+    | '(?:s|re|ve|ll|d|m)\b              # 's 're ...
+    | \w+(?:-\w+)*                       # words, state-of-the-art
+    | \S                                # anything else, one character
+    """ % "|".join(ABBREVIATIONS), re.VERBOSE | re.IGNORECASE)
+PARAGRAPH_BREAK_RE = re.compile(r"\n\s*\n")
+SENTENCE_END_TOKENS = set(".!?")
+CLOSING_TOKENS = set(")]}\"'\u201d\u2019")
+OPENING_TOKENS = set("([{\"'\u201c\u2018")
+
+
+def is_closing_token(text, start, end):
+    token = text[start:end]
+    if token in OPENING_TOKENS and (start == 0 or text[start - 1].isspace()):
+        return False  # Straight quotes are opening after a space
+    return token in CLOSING_TOKENS
+
+
+def regex_sentence_spans(text):
+    """Sentences of (start, end) spans of the tokens in text."""
+    spans = [m.span() for m in TOKEN_RE.finditer(text)]
+    sentences = []
+    sentence = []
+    for i, (start, end) in enumerate(spans):
+        sentence.append((start, end))
+        if i + 1 == len(spans):
+            break
+        next_start, next_end = spans[i + 1]
+        next_token = text[next_start:next_end]
+        if PARAGRAPH_BREAK_RE.search(text, end, next_start):
+            is_end = True
+        else:
+            # Look back past closing quotes and brackets for the . ! or ?
+            j = len(sentence) - 1
+            while j > 0 and is_closing_token(text, *sentence[j]):
+                j -= 1
+            is_end = (text[slice(*sentence[j])] in SENTENCE_END_TOKENS
+                      and next_token not in SENTENCE_END_TOKENS
+                      and not is_closing_token(text, next_start, next_end)
+                      and (next_token[0].isupper() or next_token[0].isdigit()
+                           or next_token in OPENING_TOKENS))
+        if is_end:
+            sentences.append(sentence)
+            sentence = []
+    if sentence:
+        sentences.append(sentence)
+    return sentences
+
+
+def regex_tokenize(text):
+    return [[text[start:end] for start, end in sentence]
+            for sentence in regex_sentence_spans(text)]
+
+
+def regex_sentencize(text):
+    return [
+        text[sentence[0][0]:sentence[-1][1]]
+        for sentence in regex_sentence_spans(text)
+    ]
+
+
+# == Token cache =============================================================
+# Tokenized texts are stored under <data_dir>/token_cache/, keyed by the hash
+# of the text and the tokenizer version, so that a diff can be recomputed
+# without tokenizing again. Each entry is a zlib-compressed binary record:
+#
+#   uint32 sentence count, uint32 token count
+#   uint32 end (exclusive token index) of each sentence
+#   uint32 length in characters of each token
+#   UTF-8 bytes of all tokens, concatenated
+#
+# in native byte order, since the cache is local to a machine.
+
+TOKEN_CACHE_DIR = "token_cache"
+TOKEN_CACHE_MAGIC = b"SCCTOK1\n"
+
+
+@functools.lru_cache(maxsize=None)
+def tokenizer_version(tokenizer=STANZA):
+    if tokenizer == REGEX:
+        return f"regex {REGEX_TOKENIZER_VERSION}"
+    # Read from the package metadata, without importing stanza
+    return f"stanza {importlib.metadata.version('stanza')} en tokenize"
+
+
+def token_cache_dir(conference_dir):
+    """Shared by all conferences under the same data dir, like the blobs."""
+    return os.path.join(os.path.dirname(os.path.normpath(conference_dir)),
+                        TOKEN_CACHE_DIR)
+
+
+def pack_tokens(sentences):
+    tokens = sum(sentences, [])
+    sentence_ends = array.array('I')
+    end = 0
+    for sentence in sentences:
+        end += len(sentence)
+        sentence_ends.append(end)
+    payload = (array.array('I', [len(sentences), len(tokens)]).tobytes() +
+               sentence_ends.tobytes() +
+               array.array('I', map(len, tokens)).tobytes() +
+               "".join(tokens).encode())
+    return TOKEN_CACHE_MAGIC + zlib.compress(payload)
+
+
+def unpack_tokens(data):
+    if not data.startswith(TOKEN_CACHE_MAGIC):
+        raise ValueError("Not a token cache record")
+    payload = zlib.decompress(data[len(TOKEN_CACHE_MAGIC):])
+    itemsize = array.array('I').itemsize
+    counts = array.array('I')
+    counts.frombytes(payload[:2 * itemsize])
+    num_sentences, num_tokens = counts
+    lengths = array.array('I')
+    lengths.frombytes(payload[2 * itemsize:(2 + num_sentences + num_tokens) *
+                              itemsize])
+    text = payload[(2 + num_sentences + num_tokens) * itemsize:].decode()
+
+    tokens = []
+    offset = 0
+    for length in lengths[num_sentences:]:
+        tokens.append(text[offset:offset + length])
+        offset += length
+    sentences = []
+    start = 0
+    for end in lengths[:num_sentences]:
+        sentences.append(tokens[start:end])
+        start = end
+    return sentences
+
+
+class ParagraphTokenizer(object):
+    """Tokenizes texts paragraph by paragraph, memoizing each paragraph.
+
+    Extracted texts have one paragraph per line (see 02_clean_iclr.py). The
+    initial and final versions of a paper share most paragraphs, and template
+    paragraphs (boilerplate, acknowledgements) recur across forums, so the
+    tokens of recently seen paragraphs are kept by hash and only new
+    paragraphs are tokenized, in one batch.
+
+    Caveat: the result is the same as tokenizing the whole text, except that a
+    sentence never spans a line break. stanza treats a single line break as a
+    space and may continue a sentence across it (e.g. after a heading that
+    has no final period). A paragraph's tokens may also differ slightly, since
+    the stanza model no longer sees the neighbouring lines.
+    """
+
+    def __init__(self, tokenize=tokenize_batch, max_paragraphs=200000):
+        self.tokenize = tokenize  # e.g. a ParallelTokenizer
+        self.max_paragraphs = max_paragraphs
+        self.memo = collections.OrderedDict()  # paragraph hash -> sentences
+
+    @staticmethod
+    def key(paragraph):
+        return hashlib.sha1(paragraph.encode()).digest()
+
+    def __call__(self, texts):
+        paragraphs = {}  # paragraph hash -> paragraph
+        texts_keys = []
+        for text in texts:
+            keys = []
+            for paragraph in text.split("\n"):
+                if paragraph.strip():
+                    keys.append(self.key(paragraph))
+                    paragraphs[keys[-1]] = paragraph
+            texts_keys.append(keys)
+
+        tokens = {}  # paragraph hash -> sentences
+        missing = []
+        for key in paragraphs:
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                tokens[key] = self.memo[key]
+            else:
+                missing.append(key)
+        if missing:
+            for key, sentences in zip(
+                    missing,
+                    self.tokenize([paragraphs[key] for key in missing])):
+                tokens[key] = self.memo[key] = sentences
+            while len(self.memo) > self.max_paragraphs:
+                self.memo.popitem(last=False)
+
+        return [[sentence for key in keys for sentence in tokens[key]]
+                for keys in texts_keys]
+
+
+PARALLEL_CHUNK_CHARS = 20000
+
+
+def split_at_safe_breaks(text, chunk_chars=PARALLEL_CHUNK_CHARS):
+    """Split text into chunks of at least chunk_chars characters.
+
+    Chunks end at line breaks after a sentence-ending . ! or ? and before a
+    capitalized line, where the tokenizer ends the sentence anyway, so
+    tokenizing the chunks separately gives the same sentences as tokenizing
+    the whole text (up to the context the model sees at the edges).
+    """
+    lines = text.split("\n")
+    chunks = []
+    start = 0
+    length = 0
+    for i, line in enumerate(lines[:-1]):
+        length += len(line) + 1
+        next_line = lines[i + 1].lstrip()
+        if (length >= chunk_chars
+                and line.rstrip().rstrip(")]}\"'\u201d\u2019").endswith(
+                    tuple(SENTENCE_END_TOKENS)) and next_line
+                and (next_line[0].isupper() or next_line[0].isdigit())):
+            chunks.append("\n".join(lines[start:i + 1]))
+            start = i + 1
+            length = 0
+    chunks.append("\n".join(lines[start:]))
+    return chunks
+
+
+class ParallelTokenizer(object):
+    """Tokenizes texts on several processes, splitting long texts into chunks.
+
+    Without this, one long paper (e.g. with a big appendix) goes through a
+    single stanza call and sets the wall-clock time of its whole batch. Chunks
+    are spread over the workers by size, and the sentences of each text are
+    stitched back together in order. Each worker loads its own pipeline.
+    """
+
+    def __init__(self,
+                 tokenizer=STANZA,
+                 jobs=2,
+                 chunk_chars=PARALLEL_CHUNK_CHARS):
+        self.tokenizer = tokenizer
+        self.jobs = jobs
+        self.chunk_chars = chunk_chars
+        self.executor = None  # Started on first use
+
+    def __call__(self, texts):
+        if self.executor is None:
+            # Forking after torch has started threads can deadlock
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.jobs, mp_context=multiprocessing.get_context("spawn"))
+
+        chunks = []  # (index of text, chunk)
+        for i, text in enumerate(texts):
+            chunks += [
+                (i, chunk)
+                for chunk in split_at_safe_breaks(text, self.chunk_chars)
+            ]
+
+        # Largest chunks first, each to the least loaded worker
+        groups = [[] for _ in range(self.jobs)]
+        loads = [0] * self.jobs
+        for j in sorted(range(len(chunks)), key=lambda j: -len(chunks[j][1])):
+            worker = loads.index(min(loads))
+            groups[worker].append(j)
+            loads[worker] += len(chunks[j][1])
+        groups = [group for group in groups if group]
+        futures = [
+            self.executor.submit(tokenize_batch, [chunks[j][1] for j in group],
+                                 self.tokenizer) for group in groups
+        ]
+        chunk_sentences = {}
+        for group, future in zip(groups, futures):
+            chunk_sentences.update(zip(group, future.result()))
+
+        results = [[] for _ in texts]
+        for j, (i, _) in enumerate(chunks):
+            results[i] += chunk_sentences[j]
+        return results
+
+
+class TokenCache(object):
+
+    def __init__(self,
+                 cache_dir,
+                 tokenizer=STANZA,
+                 by_paragraph=False,
+                 jobs=1):
+        self.cache_dir = cache_dir
+        self.tokenizer = tokenizer
+        self.by_paragraph = by_paragraph
+        if jobs > 1:
+            self.tokenize = ParallelTokenizer(tokenizer, jobs)
+            # Sentences may be split differently at chunk boundaries
+            self.chunk_chars = self.tokenize.chunk_chars
+        else:
+            self.tokenize = functools.partial(tokenize_batch,
+                                              tokenizer=tokenizer)
+            self.chunk_chars = None
+        if by_paragraph:
+            self.tokenize = ParagraphTokenizer(self.tokenize)
+
+    def version(self):
+        version = tokenizer_version(self.tokenizer)
+        if self.by_paragraph:
+            version += " by paragraph"
+        if self.chunk_chars is not None:
+            version += f" in chunks of {self.chunk_chars}"
+        return version
+
+    def path(self, text):
+        key = hashlib.sha256(f"{self.version()}\0{text}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f'{key}.tok')
+
+    def get(self, text):
+        """Sentences of token strings, or None if the text is not cached."""
+        try:
+            with open(self.path(text), 'rb') as f:
+                return unpack_tokens(f.read())
+        except (FileNotFoundError, ValueError, zlib.error):
+            return None
+
+    def put(self, text, sentences):
+        path = self.path(text)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Another process may be writing the same text
+        with tempfile.NamedTemporaryFile('wb',
+                                         dir=os.path.dirname(path),
+                                         delete=False) as f:
+            f.write(pack_tokens(sentences))
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+
+
+def tokenize_cached(texts, cache):
+    """Like tokenize_batch, but only tokenizes texts missing from the cache.
+    """
+    results = [cache.get(text) for text in texts]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        for i, sentences in zip(missing,
+                                cache.tokenize([texts[i] for i in missing])):
+            cache.put(texts[i], sentences)
+            results[i] = sentences
+    return results